@@ -18,10 +18,36 @@ def message_payload(string, user='symbian-s60'):
     payload = wrap(message)
     return payload
 
+# The keystream for the next message is computed by the active scheduler
+# while the device waits on the user or the bluetooth socket; a message is
+# about 60 - 100 bytes, so only 256 bytes are prefetched, 64 (4 blocks) per
+# callback to keep the UI responsive, and any more is computed when needed
+PREFETCH_LIMIT = 256
+PREFETCH_STEP = 64
+
+next_cipher = None
+
+def prepare_cipher():
+    global next_cipher
+    next_cipher = pyaes.AESModeOfOperationCTR(key.encode())
+    pyaes.KeystreamPrefetcher(next_cipher, limit = PREFETCH_LIMIT, step_size = PREFETCH_STEP, refill = False).schedule(e32.ao_sleep)
+
+# Cipher returns the prepared CTR cipher for a message (or a new one) and,
+# unless this is the last message, prepares the next
+def cipher(prepare_next = True):
+    global next_cipher
+    aes = next_cipher
+    if aes is None:
+        aes = pyaes.AESModeOfOperationCTR(key.encode())
+    next_cipher = None
+    if prepare_next:
+        prepare_cipher()
+    return aes
+
 # Wrap turns the payload into an encrypted, base64 string
 def wrap(payload):
     wrap = str(payload)
-    aes = pyaes.AESModeOfOperationCTR(key.encode())
+    aes = cipher()
     encrypted = aes.encrypt(wrap)
     wrap = b64encode(encrypted)
     return wrap
@@ -29,7 +55,8 @@ def wrap(payload):
 # Unwrap turns a base64 string into decrypted JSON
 def unwrap(str):
     unpacked = b64decode(str)
-    aes = pyaes.AESModeOfOperationCTR(key.encode())
+    # The reply is the last message of the session
+    aes = cipher(prepare_next = False)
     unwrap = aes.decrypt(unpacked)
     unwrap = unwrap.decode('utf-8')
     unwrap = simplejson().loads(unwrap.replace("'", '"'))
@@ -77,6 +104,9 @@ It must equate to the same on both the client and server files.
 # A 256 bit (32 byte) key
 key = "This_key_for_demo_purposes_only!"
 
+# Starts computing the keystream for the first message
+prepare_cipher()
+
 # This initializes simplejson for JSON parsing
 s = simplejson()
 
@@ -39,6 +39,7 @@
 #   CFB - Cipher Feedback
 #   OFB - Output Feedback
 #   CTR - Counter
+#   GCM - Galois/Counter (authenticated)
 
 # See the README.md for API details and general information.
 
@@ -48,6 +49,40 @@
 
 VERSION = [1, 3, 0]
 
+import os
+
 from .aes import AES, AESModeOfOperationCTR, AESModeOfOperationCBC, AESModeOfOperationCFB, AESModeOfOperationECB, AESModeOfOperationOFB, AESModesOfOperation, Counter
+from .aes import AESUnrolled, KeyScheduleCache, key_schedules, register_backend
+from .aes import AESModeOfOperationGCM, KeystreamPrefetcher
+from .aes import BlockMemo, KeyContext
 from .blockfeeder import decrypt_stream, Decrypter, encrypt_stream, Encrypter
+from .blockfeeder import decrypt_stream_pipelined, encrypt_stream_pipelined
 from .blockfeeder import PADDING_NONE, PADDING_DEFAULT
+
+
+# The instrumentation (see instrumentation.py) is only imported once used,
+# as most programs never use it
+
+def enable_stats():
+    '''Starts counting and timing the work done by pyaes (see stats).'''
+    from . import instrumentation
+    instrumentation.enable_stats()
+
+def disable_stats():
+    '''Stops counting, restoring the original functions; the statistics so
+       far are kept until reset_stats.'''
+    from . import instrumentation
+    instrumentation.disable_stats()
+
+def reset_stats():
+    '''Resets all the statistics to zero.'''
+    from . import instrumentation
+    instrumentation.reset_stats()
+
+def stats():
+    '''Returns a snapshot of the statistics; see instrumentation.stats.'''
+    from . import instrumentation
+    return instrumentation.stats()
+
+if os.environ.get('PYAES_STATS'):
+    enable_stats()
@@ -22,14 +22,31 @@
 
 
 from .aes import AESBlockModeOfOperation, AESSegmentModeOfOperation, AESStreamModeOfOperation
+from .aes import AESModeOfOperationCBC, AESModeOfOperationECB, AESModeOfOperationGCM
 from .util import append_PKCS7_padding, strip_PKCS7_padding, to_bufferable
 
+import sys
+import time
 
-# First we inject three functions to each of the modes of operations
+try:
+    import threading
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue
+except ImportError:
+    threading = None
+
+
+# First we inject five functions to each of the modes of operations
 #
 #    _can_consume(size)
 #       - Given a size, determine how many bytes could be consumed in
-#         a single call to either the decrypt or encrypt method
+#         a single call to either _feed_encrypt or _feed_decrypt
+#
+#    _feed_encrypt(data), _feed_decrypt(data)
+#       - encrypt (or decrypt) and return data, which is a size given
+#         by _can_consume
 #
 #    _final_encrypt(data, padding = PADDING_DEFAULT)
 #       - call and return encrypt on this (last) chunk of data,
@@ -49,11 +66,23 @@ PADDING_DEFAULT    = 'default'
 # PADDING_CIPHERTEXT_STEALING
 # PADDING_PKCS7
 
-# ECB and CBC are block-only ciphers
+# ECB and CBC are block-only ciphers; any number of whole blocks can be
+# consumed at once, and they encrypt (or decrypt) them in a single call
 
 def _block_can_consume(self, size):
-    if size >= 16: return 16
-    return 0
+    return 16 * (size // 16)
+
+def _block_feed_encrypt(self, data):
+    return to_bufferable('').join([ self.encrypt(data[i:i + 16]) for i in range(0, len(data), 16) ])
+
+def _block_feed_decrypt(self, data):
+    return to_bufferable('').join([ self.decrypt(data[i:i + 16]) for i in range(0, len(data), 16) ])
+
+def _bulk_feed_encrypt(self, data):
+    return self.encrypt_blocks(data)
+
+def _bulk_feed_decrypt(self, data):
+    return self.decrypt_blocks(data)
 
 # After padding, we may have more than one block
 def _block_final_encrypt(self, data, padding = PADDING_DEFAULT):
@@ -84,9 +113,16 @@ def _block_final_decrypt(self, data, padding = PADDING_DEFAULT):
     raise Exception('invalid padding option')
 
 AESBlockModeOfOperation._can_consume = _block_can_consume
+AESBlockModeOfOperation._feed_encrypt = _block_feed_encrypt
+AESBlockModeOfOperation._feed_decrypt = _block_feed_decrypt
 AESBlockModeOfOperation._final_encrypt = _block_final_encrypt
 AESBlockModeOfOperation._final_decrypt = _block_final_decrypt
 
+AESModeOfOperationECB._feed_encrypt = _bulk_feed_encrypt
+AESModeOfOperationECB._feed_decrypt = _bulk_feed_decrypt
+AESModeOfOperationCBC._feed_encrypt = _bulk_feed_encrypt
+AESModeOfOperationCBC._feed_decrypt = _bulk_feed_decrypt
+
 
 
 # CFB is a segment cipher
@@ -123,6 +159,12 @@ AESSegmentModeOfOperation._final_decrypt = _segment_final_decrypt
 def _stream_can_consume(self, size):
     return size
 
+def _stream_feed_encrypt(self, data):
+    return self.encrypt(data)
+
+def _stream_feed_decrypt(self, data):
+    return self.decrypt(data)
+
 def _stream_final_encrypt(self, data, padding = PADDING_DEFAULT):
     if padding not in [PADDING_NONE, PADDING_DEFAULT]:
         raise Exception('invalid padding option')
@@ -136,11 +178,69 @@ def _stream_final_decrypt(self, data, padding = PADDING_DEFAULT):
     return self.decrypt(data)
 
 AESStreamModeOfOperation._can_consume = _stream_can_consume
+AESStreamModeOfOperation._feed_encrypt = _stream_feed_encrypt
+AESStreamModeOfOperation._feed_decrypt = _stream_feed_decrypt
 AESStreamModeOfOperation._final_encrypt = _stream_final_encrypt
 AESStreamModeOfOperation._final_decrypt = _stream_final_decrypt
 
 
 
+# GCM is a stream cipher with a tag appended; the feeder always holds back
+# the last 16 bytes, which on decryption end with the tag
+
+def _gcm_final_encrypt(self, data, padding = PADDING_DEFAULT):
+    if padding not in [PADDING_NONE, PADDING_DEFAULT]:
+        raise Exception('invalid padding option')
+
+    return self.encrypt(data) + self.digest()
+
+def _gcm_final_decrypt(self, data, padding = PADDING_DEFAULT):
+    if padding not in [PADDING_NONE, PADDING_DEFAULT]:
+        raise Exception('invalid padding option')
+
+    if len(data) < self.tag_size:
+        raise ValueError('missing authentication tag')
+
+    split = len(data) - self.tag_size
+    plaintext = self.decrypt(data[:split])
+    self.verify(data[split:])
+    return plaintext
+
+AESModeOfOperationGCM._final_encrypt = _gcm_final_encrypt
+AESModeOfOperationGCM._final_decrypt = _gcm_final_decrypt
+
+
+
+# The feeder buffers input in a bytearray, which grows in place and can drop
+# the bytes consumed from its front without copying the rest; the modes of
+# operation are handed strings of bytes
+try:
+    bytearray
+
+    def _new_buffer():
+        return bytearray()
+
+    def _buffer_bytes(buffer, start, end):
+        return bytes(buffer[start:end])
+
+    def _drop_front(buffer, count):
+        del buffer[:count]
+        return buffer
+
+# Python 2.5 (Python for s60) has no bytearray; strings are copied, but
+# still only once per call to feed
+except NameError:
+    def _new_buffer():
+        return ""
+
+    def _buffer_bytes(buffer, start, end):
+        return buffer[start:end]
+
+    def _drop_front(buffer, count):
+        return buffer[count:]
+
+
+
 class BlockFeeder(object):
     '''The super-class for objects to handle chunking a stream of bytes
        into the appropriate block size for the underlying mode of operation
@@ -150,7 +250,7 @@ class BlockFeeder(object):
         self._mode = mode
         self._feed = feed
         self._final = final
-        self._buffer = to_bufferable("")
+        self._buffer = _new_buffer()
         self._padding = padding
 
     def feed(self, data = None):
@@ -166,35 +266,41 @@ class BlockFeeder(object):
 
         # Finalize; process the spare bytes we were keeping
         if data is None:
-            result = self._final(self._buffer, self._padding)
+            result = self._final(_buffer_bytes(self._buffer, 0, len(self._buffer)), self._padding)
             self._buffer = None
             return result
 
         self._buffer += to_bufferable(data)
 
-        # We keep 16 bytes around so we can determine padding
-        result = to_bufferable('')
-        while len(self._buffer) > 16:
-            can_consume = self._mode._can_consume(len(self._buffer) - 16)
+        # We keep 16 bytes around so we can determine padding; the consumed
+        # bytes are only dropped (and the results joined) once, at the end
+        buffer = self._buffer
+        (offset, end) = (0, len(buffer) - 16)
+        result = [ ]
+        while offset < end:
+            can_consume = self._mode._can_consume(end - offset)
             if can_consume == 0: break
-            result += self._feed(self._buffer[:can_consume])
-            self._buffer = self._buffer[can_consume:]
+            result.append(self._feed(_buffer_bytes(buffer, offset, offset + can_consume)))
+            offset += can_consume
 
-        return result
+        if offset:
+            self._buffer = _drop_front(buffer, offset)
+
+        return to_bufferable('').join(result)
 
 
 class Encrypter(BlockFeeder):
     'Accepts bytes of plaintext and returns encrypted ciphertext.'
 
     def __init__(self, mode, padding = PADDING_DEFAULT):
-        BlockFeeder.__init__(self, mode, mode.encrypt, mode._final_encrypt, padding)
+        BlockFeeder.__init__(self, mode, mode._feed_encrypt, mode._final_encrypt, padding)
 
 
 class Decrypter(BlockFeeder):
     'Accepts bytes of ciphertext and returns decrypted plaintext.'
 
     def __init__(self, mode, padding = PADDING_DEFAULT):
-        BlockFeeder.__init__(self, mode, mode.decrypt, mode._final_decrypt, padding)
+        BlockFeeder.__init__(self, mode, mode._feed_decrypt, mode._final_decrypt, padding)
 
 
 # 8kb blocks
@@ -225,3 +331,243 @@ def decrypt_stream(mode, in_stream, out_stream, block_size = BLOCK_SIZE, padding
 
     decrypter = Decrypter(mode, padding = padding)
     _feed_stream(decrypter, in_stream, out_stream, block_size)
+
+
+# The pipelined streams read, convert and write concurrently: a reader
+# thread fills buffers (up to PIPELINE_DEPTH of them waiting), the calling
+# thread converts them and hands the results to a writer thread. The cipher
+# holds the GIL, but reading and writing files, pipes and serial ports do
+# not, so the time spent waiting on slow media is hidden behind the cipher.
+
+PIPELINE_DEPTH = 2
+
+# The range of chunk sizes picked automatically
+MIN_BLOCK_SIZE = BLOCK_SIZE
+MAX_BLOCK_SIZE = (1 << 20)
+
+try:
+    _clock = time.perf_counter
+except AttributeError:
+    _clock = time.time
+
+# Chunks are read into reusable bytearrays where streams support readinto
+# (Python 2.5 has neither bytearray nor memoryview)
+try:
+    memoryview
+    _reusable_buffers = True
+except NameError:
+    _reusable_buffers = False
+
+
+class _BlockSizeTuner(object):
+    '''Picks the chunk size of a pipeline from the measured throughput of
+       its stages. Starting small (so the pipeline fills quickly), the size
+       doubles while the slowest stage gets at least 10% faster; once it
+       does not, the best size so far is kept.'''
+
+    STAGES = ('read', 'cipher', 'write')
+
+    def __init__(self, minimum = MIN_BLOCK_SIZE, maximum = MAX_BLOCK_SIZE, samples = 3):
+        self.size = minimum
+        self.settled = False
+        self._maximum = maximum
+        self._samples = samples
+        self._best = (None, minimum)
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._times = dict([ (stage, [0, 0, 0.0]) for stage in self.STAGES ])
+
+    def record(self, stage, size, length, seconds):
+        '''Records that stage took seconds for length bytes of a chunk read
+           with size (chunks read before the size last changed are
+           ignored).'''
+
+        self._lock.acquire()
+        try:
+            if self.settled or size != self.size:
+                return
+
+            times = self._times[stage]
+            times[0] += 1
+            times[1] += length
+            times[2] += seconds
+
+            for (count, total, elapsed) in self._times.values():
+                if count < self._samples:
+                    return
+
+            # The pipeline runs at the rate of its slowest stage
+            throughput = min([ total / max(elapsed, 1e-9) for (count, total, elapsed) in self._times.values() ])
+
+            best = self._best[0]
+            if best is None or throughput > 1.1 * best:
+                self._best = (throughput, size)
+                if size < self._maximum:
+                    self.size = min(2 * size, self._maximum)
+                    self._reset()
+                    return
+            elif throughput > best:
+                self._best = (throughput, size)
+
+            self.size = self._best[1]
+            self.settled = True
+        finally:
+            self._lock.release()
+
+
+def _put(items, item, stopped):
+    'Puts item on a bounded queue, unless the pipeline is stopped first.'
+
+    while not stopped:
+        try:
+            items.put(item, True, 0.1)
+            return
+        except queue.Full:
+            pass
+
+def _read_stage(in_stream, chunks, free, block_size, tuner, errors, stopped):
+    readinto = None
+    if _reusable_buffers:
+        readinto = getattr(in_stream, 'readinto', None)
+
+    try:
+        while not stopped:
+            size = block_size
+            if tuner is not None:
+                size = tuner.size
+
+            start = _clock()
+            if readinto is not None:
+                # Reuse a buffer the cipher stage is done with, if it is big enough
+                try:
+                    buffer = free.get_nowait()
+                except queue.Empty:
+                    buffer = None
+                if buffer is None or len(buffer) < size:
+                    buffer = bytearray(size)
+                length = readinto(memoryview(buffer)[:size]) or 0
+                data = memoryview(buffer)[:length]
+            else:
+                buffer = None
+                data = in_stream.read(size)
+                length = len(data)
+
+            if not length:
+                break
+            if tuner is not None:
+                tuner.record('read', size, length, _clock() - start)
+
+            _put(chunks, (data, buffer, size), stopped)
+        _put(chunks, None, stopped)
+    except Exception:
+        errors.append(sys.exc_info()[1])
+        stopped.append(True)
+
+def _write_stage(out_stream, results, tuner, errors, stopped):
+    # Always drains results, so the cipher stage never blocks on a dead writer
+    while True:
+        item = results.get()
+        if item is None:
+            break
+        if stopped:
+            continue
+
+        (data, size, length) = item
+        try:
+            start = _clock()
+            out_stream.write(data)
+            if tuner is not None and size is not None:
+                tuner.record('write', size, length, _clock() - start)
+        except Exception:
+            errors.append(sys.exc_info()[1])
+            stopped.append(True)
+
+def _pipeline_stream(feeder, in_stream, out_stream, block_size = None):
+    '''Like _feed_stream, with in_stream read from and out_stream written to
+       by threads of their own; if block_size is None, it is picked from
+       the measured throughput of the stages.'''
+
+    if threading is None:
+        return _feed_stream(feeder, in_stream, out_stream, block_size or BLOCK_SIZE)
+
+    tuner = None
+    if block_size is None:
+        tuner = _BlockSizeTuner()
+
+    chunks = queue.Queue(PIPELINE_DEPTH)
+    results = queue.Queue(PIPELINE_DEPTH)
+    free = queue.Queue()
+
+    # Shared with the threads; stopped is only ever appended to
+    (errors, stopped) = ([ ], [ ])
+
+    reader = threading.Thread(target = _read_stage, args = (in_stream, chunks, free, block_size, tuner, errors, stopped))
+    writer = threading.Thread(target = _write_stage, args = (out_stream, results, tuner, errors, stopped))
+    for thread in (reader, writer):
+        thread.daemon = True
+        thread.start()
+
+    try:
+        try:
+            while not stopped:
+                try:
+                    item = chunks.get(True, 0.1)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    break
+
+                (data, buffer, size) = item
+                start = _clock()
+                converted = feeder.feed(data)
+                if tuner is not None:
+                    tuner.record('cipher', size, len(data), _clock() - start)
+
+                # The feeder has copied the data; the buffer can be refilled
+                if buffer is not None:
+                    free.put(buffer)
+                results.put((converted, size, len(data)))
+
+            if not stopped:
+                results.put((feeder.feed(), None, 0))
+        except Exception:
+            errors.append(sys.exc_info()[1])
+            stopped.append(True)
+    finally:
+        results.put(None)
+        writer.join()
+
+        # Stop the reader; after an error, it is not waited for, as it may
+        # be blocked reading from a pipe or serial port
+        if not stopped:
+            stopped.append(True)
+        try:
+            while True:
+                chunks.get_nowait()
+        except queue.Empty:
+            pass
+        if not errors:
+            reader.join()
+
+    if errors:
+        raise errors[0]
+
+
+def encrypt_stream_pipelined(mode, in_stream, out_stream, block_size = None, padding = PADDING_DEFAULT):
+    '''Encrypts a stream of bytes from in_stream to out_stream using mode,
+       like encrypt_stream, but reading and writing in threads of their own
+       while encrypting. If block_size is None, it is picked automatically.'''
+
+    encrypter = Encrypter(mode, padding = padding)
+    _pipeline_stream(encrypter, in_stream, out_stream, block_size)
+
+
+def decrypt_stream_pipelined(mode, in_stream, out_stream, block_size = None, padding = PADDING_DEFAULT):
+    '''Decrypts a stream of bytes from in_stream to out_stream using mode,
+       like decrypt_stream, but reading and writing in threads of their own
+       while decrypting. If block_size is None, it is picked automatically.'''
+
+    decrypter = Decrypter(mode, padding = padding)
+    _pipeline_stream(decrypter, in_stream, out_stream, block_size)
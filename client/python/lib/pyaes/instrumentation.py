@@ -0,0 +1,304 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Richard Moore
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Optional instrumentation of the hot paths of pyaes.
+#
+# Nothing in aes.py or blockfeeder.py checks whether statistics are enabled;
+# instead, enable_stats replaces the functions and methods of interest (on
+# their classes and modules) with counting and timing wrappers, and
+# disable_stats puts the originals back. So while disabled, there is no
+# cost at all. This module is only imported (by the functions of the same
+# names in __init__.py) once statistics are used; setting the PYAES_STATS
+# environment variable enables them when pyaes is imported.
+#
+# Phases (each timed in nanoseconds; nested calls of the same phase, such
+# as a backend's decrypt calling its decrypt_blocks, are only timed once):
+#
+#   key_expansion   expanding keys (and deriving decryption round keys)
+#   block_cipher    the block cipher, one block or a batch at a time
+#   counter         producing CTR counter blocks
+#   conversion      converting input to strings of bytes
+#   xor             XORing strings of bytes
+#
+# Modes of operation (and block cipher functions) that were set up before
+# enable_stats keep the functions they already hold, and are only partly
+# counted.
+
+
+import time
+
+from . import aes
+from . import blockfeeder
+
+try:
+    import threading
+except ImportError:
+    threading = None
+
+__all__ = ["disable_stats", "enable_stats", "reset_stats", "stats"]
+
+
+PHASES = ('key_expansion', 'block_cipher', 'counter', 'conversion', 'xor')
+
+try:
+    _clock = time.perf_counter_ns
+except AttributeError:
+    def _clock():
+        return int(time.time() * 1000000000)
+
+
+class _Local(object):
+    pass
+
+if threading is not None:
+    _local = threading.local()
+    _lock = threading.Lock()
+else:
+    _local = _Local()
+    _lock = None
+
+_stats = None
+
+# (owner, name, original) for every attribute replaced by enable_stats
+_patched = [ ]
+
+
+def _new_stats():
+    return dict(
+        key_schedules = 0,
+        blocks = dict(encrypt = 0, decrypt = 0),
+        ns = dict([ (phase, 0) for phase in PHASES ]),
+        modes = dict(),
+    )
+
+def _add(phase, elapsed, direction = None, blocks = 0):
+    if _lock is not None: _lock.acquire()
+    try:
+        _stats['ns'][phase] += elapsed
+        if direction is not None:
+            _stats['blocks'][direction] += blocks
+        elif phase == 'key_expansion' and blocks:
+            _stats['key_schedules'] += blocks
+    finally:
+        if _lock is not None: _lock.release()
+
+
+def _timed(phase, function, direction = None, blocks = None):
+    '''Returns function, timed as phase. For the block cipher, blocks is
+       a function of the arguments returning the number of blocks.'''
+
+    def wrapper(*args, **kwargs):
+        if getattr(_local, phase, False):
+            return function(*args, **kwargs)
+
+        setattr(_local, phase, True)
+        start = _clock()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = _clock() - start
+            setattr(_local, phase, False)
+            count = 0
+            if blocks is not None:
+                count = blocks(args)
+            _add(phase, elapsed, direction, count)
+
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+
+def _mode_call(mode_name, function):
+    'Returns a method of a mode of operation, counting calls and bytes.'
+
+    def wrapper(self, data, *args):
+        if getattr(_local, 'mode', False):
+            return function(self, data, *args)
+
+        _local.mode = True
+        try:
+            result = function(self, data, *args)
+        finally:
+            _local.mode = False
+
+        if _lock is not None: _lock.acquire()
+        try:
+            counts = _stats['modes'].get(mode_name)
+            if counts is None:
+                counts = _stats['modes'][mode_name] = dict(calls = 0, blocks = 0, bytes_in = 0, bytes_out = 0)
+            counts['calls'] += 1
+            counts['blocks'] += (len(data) + 15) // 16
+            counts['bytes_in'] += len(data)
+            counts['bytes_out'] += len(result)
+        finally:
+            if _lock is not None: _lock.release()
+
+        return result
+
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+
+def _compiled(direction, method):
+    'Returns a compiled_encrypt (or compiled_decrypt) with timed results.'
+
+    def wrapper(self):
+        return _timed('block_cipher', method(self), direction, _one_block)
+    return wrapper
+
+
+def _one_block(args):
+    return 1
+
+def _batch(args):
+    return len(args[-1]) // 16
+
+def _keystream_blocks(args):
+    return args[-1]
+
+def _one_key(args):
+    return 1
+
+
+def _patch(owner, name, replacement):
+    # Only replace what the owner itself defines (not what it inherits)
+    if isinstance(owner, type):
+        original = owner.__dict__.get(name)
+    else:
+        original = getattr(owner, name, None)
+    if original is None:
+        return
+
+    _patched.append((owner, name, original))
+    setattr(owner, name, replacement(original))
+
+
+def enable_stats():
+    '''Starts counting and timing the work done by pyaes (see stats).'''
+
+    global _stats
+
+    if _stats is None:
+        _stats = _new_stats()
+    if _patched:
+        return
+
+    timed = lambda phase, direction = None, blocks = None: (lambda f: _timed(phase, f, direction, blocks))
+
+    # Key expansion
+    _patch(aes.AES, '__init__', timed('key_expansion', None, _one_key))
+    _patch(aes.AES, '_expand_decryption_key', timed('key_expansion'))
+
+    # The block cipher; single blocks, compiled functions and the batch
+    # engines and backends
+    for engine in (aes.AES, aes.AESUnrolled):
+        _patch(engine, 'encrypt', timed('block_cipher', 'encrypt', _one_block))
+        _patch(engine, 'decrypt', timed('block_cipher', 'decrypt', _one_block))
+    _patch(aes.AESUnrolled, 'compiled_encrypt', lambda f: _compiled('encrypt', f))
+    _patch(aes.AESUnrolled, 'compiled_decrypt', lambda f: _compiled('decrypt', f))
+
+    _patch(aes, '_vector_encrypt_blocks', timed('block_cipher', 'encrypt', _batch))
+    _patch(aes, '_bitsliced_encrypt_blocks', timed('block_cipher', 'encrypt', _batch))
+
+    # Blocks split between the processes of the pool are only timed here
+    def parallel_blocks(function):
+        def wrapper(self, blocks, decrypt):
+            if getattr(_local, 'block_cipher', False):
+                return function(self, blocks, decrypt)
+            start = _clock()
+            result = function(self, blocks, decrypt)
+            if result is not None:
+                _add('block_cipher', _clock() - start, decrypt and 'decrypt' or 'encrypt', len(blocks) // 16)
+            return result
+        return wrapper
+    _patch(aes.AESBlockModeOfOperation, '_parallel_blocks', parallel_blocks)
+
+    backend = getattr(aes, 'LibcryptoAES', None)
+    if backend is not None:
+        _patch(backend, '__init__', timed('key_expansion', None, _one_key))
+        _patch(backend, 'encrypt', timed('block_cipher', 'encrypt', _one_block))
+        _patch(backend, 'encrypt_blocks', timed('block_cipher', 'encrypt', _batch))
+        _patch(backend, 'decrypt_blocks', timed('block_cipher', 'decrypt', _batch))
+        _patch(backend, 'ctr_keystream', timed('block_cipher', 'encrypt', _keystream_blocks))
+        _patch(backend, 'cbc_encrypt', timed('block_cipher', 'encrypt', _batch))
+
+    # Counter blocks
+    for name in ('increment', 'advance', 'blocks', '_run_start'):
+        _patch(aes.Counter, name, timed('counter'))
+
+    # Conversion and XOR
+    _patch(aes, '_to_bytes', timed('conversion'))
+    _patch(blockfeeder, 'to_bufferable', timed('conversion'))
+    _patch(aes, '_xor_bytes', timed('xor'))
+
+    # Calls, blocks and bytes for each mode of operation
+    for (mode_name, mode) in aes.AESModesOfOperation.items():
+        for name in ('encrypt', 'decrypt', 'encrypt_blocks', 'decrypt_blocks'):
+            _patch(mode, name, lambda f, m = mode_name: _mode_call(m, f))
+
+def disable_stats():
+    '''Stops counting, restoring the original functions; the statistics so
+       far are kept until reset_stats.'''
+
+    while _patched:
+        (owner, name, original) = _patched.pop()
+        setattr(owner, name, original)
+
+def reset_stats():
+    '''Resets all the statistics to zero.'''
+
+    global _stats
+
+    if _lock is not None: _lock.acquire()
+    try:
+        if _stats is not None:
+            _stats = _new_stats()
+    finally:
+        if _lock is not None: _lock.release()
+
+def stats():
+    '''Returns a snapshot of the statistics, as a dict with:
+
+         enabled        whether statistics are being collected
+         key_schedules  keys expanded
+         blocks         blocks through the block cipher, by direction
+         ns             nanoseconds spent in each phase (see PHASES)
+         modes          for each mode of operation ("ctr", "cbc", ...), the
+                        calls, blocks, bytes_in and bytes_out'''
+
+    if _lock is not None: _lock.acquire()
+    try:
+        snapshot = _stats
+        if snapshot is None:
+            snapshot = _new_stats()
+
+        result = dict(
+            enabled = bool(_patched),
+            key_schedules = snapshot['key_schedules'],
+            blocks = dict(snapshot['blocks']),
+            ns = dict(snapshot['ns']),
+            modes = dict([ (name, dict(counts)) for (name, counts) in snapshot['modes'].items() ]),
+        )
+    finally:
+        if _lock is not None: _lock.release()
+
+    return result
+
@@ -39,6 +39,8 @@ except:
     def to_bufferable(binary):
         if isinstance(binary, bytes):
             return binary
+        if isinstance(binary, (bytearray, memoryview)):
+            return bytes(binary)
         return bytes(ord(b) for b in binary)
 
     def _get_byte(c):
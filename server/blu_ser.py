@@ -18,10 +18,23 @@ def message_payload(string, user='symbian-s60'):
     payload = wrap(message)
     return payload
 
+# The keystream for the next message is computed by a background thread
+# while the server waits on the bluetooth port
+def prepare_cipher():
+    global next_cipher
+    next_cipher = pyaes.AESModeOfOperationCTR(key_context)
+    pyaes.KeystreamPrefetcher(next_cipher, refill = False).start()
+
+# Cipher returns the prepared CTR cipher for a message and prepares the next
+def cipher():
+    aes = next_cipher
+    prepare_cipher()
+    return aes
+
 # Wrap turns the payload into an encrypted, base64 string
 def wrap(payload):
     wrap = str(payload)
-    aes = pyaes.AESModeOfOperationCTR(key.encode())
+    aes = cipher()
     encrypted = aes.encrypt(wrap)
     wrap = b64encode(encrypted)
     return wrap
@@ -29,7 +42,7 @@ def wrap(payload):
 # Unwrap turns a base64 string into decrypted JSON
 def unwrap(str):
     unpacked = b64decode(str)
-    aes = pyaes.AESModeOfOperationCTR(key.encode())
+    aes = cipher()
     unwrap = aes.decrypt(unpacked)
     unwrap = unwrap.decode('utf-8')
     unwrap = json.loads(unwrap.replace("'", '"'))
@@ -44,6 +57,12 @@ It must equate to the same on both the client and server files.
 # A 256 bit (32 byte) key
 key = "This_key_for_demo_purposes_only!"
 
+# Every message's cipher shares the key schedule of this context
+key_context = pyaes.KeyContext(key.encode())
+
+# Starts computing the keystream for the first message
+prepare_cipher()
+
 '''
 This discovers ports on the server and uses the one for bluetooth
 
@@ -0,0 +1,387 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Richard Moore
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# asyncio adapters for the feeders of blockfeeder.py:
+#
+#   encrypt_stream_async, decrypt_stream_async
+#       - like encrypt_stream and decrypt_stream, from an asyncio.StreamReader
+#         to an asyncio.StreamWriter
+#
+#   CipherProtocol
+#       - wraps an asyncio.Protocol, so everything it writes is encrypted and
+#         everything it receives is decrypted
+#
+# The cipher holds the GIL, but an event loop must not be kept from its
+# other connections by a large chunk; chunks of at least inline_threshold
+# bytes are converted in an executor (the loop's default one, unless given),
+# smaller ones inline, where the executor would cost more than the cipher.
+# Each feeder converts one chunk at a time, in order.
+#
+# This module is only shipped with the server, as it needs Python 3.7.
+
+
+import asyncio
+import collections
+
+from .aes import AESModeOfOperationGCM, AESSegmentModeOfOperation, AESStreamModeOfOperation
+from .blockfeeder import BLOCK_SIZE, PADDING_DEFAULT, Decrypter, Encrypter
+
+
+__all__ = ["CipherProtocol", "decrypt_stream_async", "encrypt_stream_async"]
+
+
+# Chunks smaller than this are converted inline, on the event loop
+INLINE_THRESHOLD = (1 << 14)
+
+
+async def _convert(convert, data, executor, inline_threshold):
+    if len(data) < inline_threshold:
+        return convert(data)
+    return await asyncio.get_running_loop().run_in_executor(executor, convert, data)
+
+async def _feed_stream_async(feeder, reader, writer, block_size, executor, inline_threshold):
+    'Uses feeder to read and convert from reader and write to writer.'
+
+    while True:
+        chunk = await reader.read(block_size)
+        if not chunk:
+            break
+        writer.write(await _convert(feeder.feed, chunk, executor, inline_threshold))
+        await writer.drain()
+    writer.write(feeder.feed())
+    await writer.drain()
+
+
+async def encrypt_stream_async(mode, reader, writer, block_size = BLOCK_SIZE, padding = PADDING_DEFAULT, executor = None, inline_threshold = INLINE_THRESHOLD):
+    '''Encrypts a stream of bytes from reader (an asyncio.StreamReader) to
+       writer (an asyncio.StreamWriter) using mode. The writer is not
+       closed.'''
+
+    encrypter = Encrypter(mode, padding = padding)
+    await _feed_stream_async(encrypter, reader, writer, block_size, executor, inline_threshold)
+
+
+async def decrypt_stream_async(mode, reader, writer, block_size = BLOCK_SIZE, padding = PADDING_DEFAULT, executor = None, inline_threshold = INLINE_THRESHOLD):
+    '''Decrypts a stream of bytes from reader (an asyncio.StreamReader) to
+       writer (an asyncio.StreamWriter) using mode. The writer is not
+       closed.'''
+
+    decrypter = Decrypter(mode, padding = padding)
+    await _feed_stream_async(decrypter, reader, writer, block_size, executor, inline_threshold)
+
+
+
+def _converters(mode, encrypt, padding):
+    '''Returns (convert, final) functions for one direction of mode.
+
+       OFB and CTR are used directly, as they need no padding: a feeder
+       always holds back the last 16 bytes until the final call, which an
+       interactive protocol cannot wait for.'''
+
+    if (isinstance(mode, AESStreamModeOfOperation) and
+            not isinstance(mode, (AESSegmentModeOfOperation, AESModeOfOperationGCM))):
+        if encrypt:
+            return (mode.encrypt, lambda: b'')
+        return (mode.decrypt, lambda: b'')
+
+    if encrypt:
+        feeder = Encrypter(mode, padding = padding)
+    else:
+        feeder = Decrypter(mode, padding = padding)
+    return (feeder.feed, feeder.feed)
+
+
+class _Direction(object):
+    '''Converts the chunks of one direction of a CipherProtocol in order,
+       passing each result to deliver; after finish, the final bytes are
+       delivered and then the callbacks given to when_done are called.'''
+
+    def __init__(self, protocol, convert, final, deliver, executor, inline_threshold):
+        self._protocol = protocol
+        self._convert = convert
+        self._final = final
+        self._deliver = deliver
+        self._executor = executor
+        self._inline_threshold = inline_threshold
+
+        self._pending = collections.deque()
+        self._pending_bytes = 0
+        self._task = None
+        self._callbacks = [ ]
+        self.finished = False
+        self.completed = False
+
+    def push(self, data):
+        if self.finished:
+            raise RuntimeError('data after the end of the stream')
+
+        # Nothing waiting ahead of a small chunk; convert it right away
+        if self._task is None and len(data) < self._inline_threshold:
+            self._step(data)
+            return
+
+        self._pending.append(data)
+        self._pending_bytes += len(data)
+        self._start()
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+
+        if self._task is None:
+            self._step(None)
+        else:
+            self._pending.append(None)
+
+    def when_done(self, callback):
+        if self.completed:
+            callback()
+        else:
+            self._callbacks.append(callback)
+
+    @property
+    def pending_bytes(self):
+        return self._pending_bytes
+
+    def cancel(self):
+        self._callbacks = [ ]
+        self._pending.clear()
+        self._pending_bytes = 0
+        if self._task is not None:
+            self._task.cancel()
+
+    def _start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def _step(self, data, converted = None):
+        try:
+            if data is None:
+                self._deliver(self._final())
+                self.completed = True
+                (callbacks, self._callbacks) = (self._callbacks, [ ])
+                for callback in callbacks:
+                    callback()
+                return
+            if converted is None:
+                converted = self._convert(data)
+            self._deliver(converted)
+        except Exception as e:
+            self._protocol._failed(e)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self._pending:
+                data = self._pending.popleft()
+                if data is None:
+                    self._step(None)
+                    continue
+
+                self._pending_bytes -= len(data)
+                converted = None
+                if len(data) >= self._inline_threshold:
+                    try:
+                        converted = await loop.run_in_executor(self._executor, self._convert, data)
+                    except Exception as e:
+                        self._protocol._failed(e)
+                        return
+                self._step(data, converted)
+                self._protocol._drained()
+        finally:
+            self._task = None
+
+
+class _CipherTransport(asyncio.Transport):
+    '''The transport given to the protocol wrapped by a CipherProtocol; what
+       is written to it is encrypted and written to the real transport.'''
+
+    def __init__(self, cipher_protocol, transport):
+        asyncio.Transport.__init__(self)
+        self._cipher_protocol = cipher_protocol
+        self._transport = transport
+        self._closing = False
+
+    def get_extra_info(self, name, default = None):
+        return self._transport.get_extra_info(name, default)
+
+    def is_closing(self):
+        return self._closing or self._transport.is_closing()
+
+    def write(self, data):
+        if self._closing:
+            raise RuntimeError('write after close or write_eof')
+        if data:
+            self._cipher_protocol._outgoing.push(bytes(data))
+
+    def can_write_eof(self):
+        return self._transport.can_write_eof()
+
+    def write_eof(self):
+        # The final bytes (eg. padding or a GCM tag) go before the EOF
+        self._closing = True
+        outgoing = self._cipher_protocol._outgoing
+        outgoing.finish()
+        outgoing.when_done(self._transport.write_eof)
+
+    def close(self):
+        self._closing = True
+        outgoing = self._cipher_protocol._outgoing
+        outgoing.finish()
+        outgoing.when_done(self._transport.close)
+
+    def abort(self):
+        self._closing = True
+        self._cipher_protocol._cancel()
+        self._transport.abort()
+
+    def get_write_buffer_size(self):
+        return self._cipher_protocol._outgoing.pending_bytes + self._transport.get_write_buffer_size()
+
+    def set_write_buffer_limits(self, high = None, low = None):
+        self._transport.set_write_buffer_limits(high, low)
+
+    def pause_reading(self):
+        self._cipher_protocol._app_paused = True
+        self._cipher_protocol._update_reading()
+
+    def resume_reading(self):
+        self._cipher_protocol._app_paused = False
+        self._cipher_protocol._update_reading()
+
+    def is_reading(self):
+        return not self._cipher_protocol._app_paused
+
+
+class CipherProtocol(asyncio.Protocol):
+    '''Wraps protocol, encrypting everything it writes with encrypt_mode and
+       decrypting everything it receives with decrypt_mode (each a new mode
+       of operation, as both directions are separate streams) before it sees
+       it. The wrapped protocol is given a transport of its own.
+
+       The final bytes of each direction (padding for ECB and CBC, the tag
+       for GCM) are written by write_eof or close, and expected before the
+       peer's EOF; a tag that does not verify (or bad padding) aborts the
+       connection, and the error is passed to connection_lost.
+
+       Received data waiting for the executor beyond high_water bytes pauses
+       reading from the transport.
+
+       For example, with a server:
+
+         def factory():
+             return CipherProtocol(EchoProtocol(), AESModeOfOperationCTR(key, Counter(1, nonce_a)),
+                                   AESModeOfOperationCTR(key, Counter(1, nonce_b)))
+         server = await loop.create_server(factory, host, port)'''
+
+    def __init__(self, protocol, encrypt_mode, decrypt_mode, padding = PADDING_DEFAULT, executor = None, inline_threshold = INLINE_THRESHOLD, high_water = (1 << 20)):
+        self.protocol = protocol
+        self._encrypt_mode = encrypt_mode
+        self._decrypt_mode = decrypt_mode
+        self._padding = padding
+        self._executor = executor
+        self._inline_threshold = inline_threshold
+        self._high_water = high_water
+
+        self._transport = None
+        self._cipher_transport = None
+        self._outgoing = None
+        self._incoming = None
+        self._error = None
+        self._app_paused = False
+        self._reading_paused = False
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._cipher_transport = _CipherTransport(self, transport)
+
+        (convert, final) = _converters(self._encrypt_mode, True, self._padding)
+        self._outgoing = _Direction(self, convert, final, transport.write, self._executor, self._inline_threshold)
+
+        (convert, final) = _converters(self._decrypt_mode, False, self._padding)
+        self._incoming = _Direction(self, convert, final, self._received, self._executor, self._inline_threshold)
+
+        self.protocol.connection_made(self._cipher_transport)
+
+    def data_received(self, data):
+        if self._error is not None:
+            return
+        self._incoming.push(data)
+        self._update_reading()
+
+    def eof_received(self):
+        self._incoming.finish()
+        self._incoming.when_done(self._eof)
+
+        # The transport is closed (if the wrapped protocol wants) once the
+        # final bytes have been delivered
+        return True
+
+    def connection_lost(self, exc):
+        self._cancel()
+        if exc is None:
+            exc = self._error
+        self.protocol.connection_lost(exc)
+
+    def pause_writing(self):
+        self.protocol.pause_writing()
+
+    def resume_writing(self):
+        self.protocol.resume_writing()
+
+    def _received(self, data):
+        if data:
+            self.protocol.data_received(data)
+
+    def _eof(self):
+        if not self.protocol.eof_received():
+            self._cipher_transport.close()
+
+    def _failed(self, error):
+        if self._error is None:
+            self._error = error
+        self._cancel()
+        if self._transport is not None:
+            self._transport.abort()
+
+    def _cancel(self):
+        for direction in (self._outgoing, self._incoming):
+            if direction is not None:
+                direction.cancel()
+
+    def _drained(self):
+        self._update_reading()
+
+    def _update_reading(self):
+        'Pauses or resumes reading from the transport, as needed.'
+
+        if self._transport is None or self._transport.is_closing():
+            return
+
+        paused = self._app_paused or self._incoming.pending_bytes > self._high_water
+        if paused != self._reading_paused:
+            self._reading_paused = paused
+            if paused:
+                self._transport.pause_reading()
+            else:
+                self._transport.resume_reading()
@@ -0,0 +1,253 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Richard Moore
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Micro-benchmarks for pyaes, written as JSON so runs can be compared:
+#
+#   key_setup   expanding a key (and deriving its decryption round keys)
+#   block       encrypting and decrypting a single block with AESUnrolled
+#   modes       MB/s of each mode of operation, by key size and payload size
+#   streams     MB/s of encrypt_stream and decrypt_stream, likewise
+#
+# Usage (from the server directory):
+#
+#   python -m pyaes.benchmark [--output results.json] [--quick]
+#
+# Every measurement uses a fresh mode of operation and takes the best of as
+# many runs as fit in --min-time seconds (at least one). The engines used
+# depend on the environment (NumPy, PYAES_BACKEND), which is recorded.
+#
+# This module is only shipped with the server; it only needs the standard
+# library.
+
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+from io import BytesIO
+
+from . import aes
+from .aes import AESUnrolled, AESModesOfOperation, Counter
+from .blockfeeder import decrypt_stream, encrypt_stream
+
+
+__all__ = ["run"]
+
+
+MODES = ('ecb', 'cbc', 'cfb', 'ofb', 'ctr')
+KEY_SIZES = (16, 24, 32)
+
+# 16 bytes to 16 MB, in steps of 16
+PAYLOAD_SIZES = tuple(16 ** i for i in range(1, 7))
+QUICK_SIZES = PAYLOAD_SIZES[:4]
+
+
+def _create_mode(name, key):
+    'Returns a new mode of operation for name (cfb is CFB-128, cfb8 CFB-8).'
+
+    if name == 'ctr':
+        return AESModesOfOperation['ctr'](key, Counter())
+    if name == 'cfb':
+        return AESModesOfOperation['cfb'](key, b'\0' * 16, 16)
+    if name == 'cfb8':
+        return AESModesOfOperation['cfb'](key, b'\0' * 16, 1)
+    if name == 'gcm':
+        return AESModesOfOperation['gcm'](key, b'\0' * 12)
+    if name == 'ecb':
+        return AESModesOfOperation['ecb'](key)
+    return AESModesOfOperation[name](key, b'\0' * 16)
+
+def _crypt(name, mode, data, decrypt):
+    'Encrypts (or decrypts) data with the fastest call each mode offers.'
+
+    if name in ('ecb', 'cbc'):
+        if decrypt:
+            return mode.decrypt_blocks(data)
+        return mode.encrypt_blocks(data)
+
+    if decrypt:
+        return mode.decrypt(data)
+    return mode.encrypt(data)
+
+
+def _best_time(setup, function, min_time):
+    '''Calls function(setup()) until min_time seconds have been spent in it,
+       returning the shortest call (in seconds) and the number of calls.'''
+
+    (best, total, runs) = (None, 0.0, 0)
+    while runs == 0 or total < min_time:
+        argument = setup()
+        start = time.perf_counter()
+        function(argument)
+        elapsed = time.perf_counter() - start
+
+        total += elapsed
+        runs += 1
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return (best, runs)
+
+def _rate(size, seconds):
+    if seconds <= 0:
+        return None
+    return size / seconds / 1e6
+
+
+def _bench_key_setup(key_sizes, min_time):
+    results = [ ]
+    for key_size in key_sizes:
+        key = os.urandom(key_size)
+        (encrypt, runs) = _best_time(lambda: key, AESUnrolled, min_time)
+        (decrypt, runs) = _best_time(lambda: AESUnrolled(key), lambda a: a._expand_decryption_key(), min_time)
+        results.append(dict(key_bits = 8 * key_size, expand_us = 1e6 * encrypt, expand_decryption_us = 1e6 * decrypt))
+    return results
+
+def _bench_block(key_sizes, min_time):
+    results = [ ]
+    block = os.urandom(16)
+    for key_size in key_sizes:
+        cipher = AESUnrolled(os.urandom(key_size))
+        cipher.decrypt(cipher.encrypt(block))
+
+        # A single call is too short to time; take the mean of a batch
+        count = 1000
+        (encrypt, runs) = _best_time(lambda: None, lambda a: [ cipher.encrypt(block) for i in range(count) ], min_time)
+        (decrypt, runs) = _best_time(lambda: None, lambda a: [ cipher.decrypt(block) for i in range(count) ], min_time)
+        results.append(dict(key_bits = 8 * key_size, encrypt_us = 1e6 * encrypt / count, decrypt_us = 1e6 * decrypt / count))
+    return results
+
+def _bench_modes(modes, key_sizes, sizes, min_time, log):
+    results = [ ]
+    for name in modes:
+        for key_size in key_sizes:
+            key = os.urandom(key_size)
+            for size in sizes:
+                plaintext = os.urandom(size)
+                ciphertext = _crypt(name, _create_mode(name, key), plaintext, False)
+                if _crypt(name, _create_mode(name, key), ciphertext, True) != plaintext:
+                    raise AssertionError('%s round trip failed' % name)
+
+                for (direction, data) in (('encrypt', plaintext), ('decrypt', ciphertext)):
+                    decrypt = (direction == 'decrypt')
+                    (seconds, runs) = _best_time(lambda: _create_mode(name, key),
+                                                 lambda mode: _crypt(name, mode, data, decrypt), min_time)
+                    results.append(dict(mode = name, key_bits = 8 * key_size, size = size, direction = direction,
+                                        seconds = seconds, mb_per_s = _rate(size, seconds), runs = runs))
+                    log('%-4s %3d-bit %9d B %-7s %9.3f MB/s' % (name, 8 * key_size, size, direction, _rate(size, seconds) or 0))
+    return results
+
+def _bench_streams(modes, key_sizes, sizes, min_time, log):
+    results = [ ]
+    for name in modes:
+        for key_size in key_sizes:
+            key = os.urandom(key_size)
+            for size in sizes:
+                plaintext = os.urandom(size)
+                output = BytesIO()
+                encrypt_stream(_create_mode(name, key), BytesIO(plaintext), output)
+                ciphertext = output.getvalue()
+
+                for (direction, stream, data) in (('encrypt', encrypt_stream, plaintext), ('decrypt', decrypt_stream, ciphertext)):
+                    (seconds, runs) = _best_time(lambda: _create_mode(name, key),
+                                                 lambda mode: stream(mode, BytesIO(data), BytesIO()), min_time)
+                    results.append(dict(mode = name, key_bits = 8 * key_size, size = size, direction = direction,
+                                        seconds = seconds, mb_per_s = _rate(size, seconds), runs = runs))
+                    log('%-4s %3d-bit %9d B %-7s stream %9.3f MB/s' % (name, 8 * key_size, size, direction, _rate(size, seconds) or 0))
+    return results
+
+
+def _environment():
+    from . import VERSION
+    return dict(
+        pyaes = '.'.join([ str(v) for v in VERSION ]),
+        python = platform.python_version(),
+        implementation = platform.python_implementation(),
+        platform = platform.platform(),
+        machine = platform.machine(),
+        cpus = os.cpu_count(),
+        backend = os.environ.get('PYAES_BACKEND', 'python'),
+        numpy = aes._vector_encrypt_blocks is not None,
+        bitsliced = aes._bitsliced_encrypt_blocks is not None,
+        time = time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    )
+
+def run(modes = MODES, key_sizes = KEY_SIZES, sizes = PAYLOAD_SIZES, streams = True, min_time = 0.2, log = None):
+    '''Runs the benchmarks, returning the results as a dict (see the top
+       of this module); log is called with a line for each measurement.'''
+
+    if log is None:
+        log = lambda line: None
+
+    results = dict(environment = _environment())
+    results['key_setup'] = _bench_key_setup(key_sizes, min_time)
+    results['block'] = _bench_block(key_sizes, min_time)
+    results['modes'] = _bench_modes(modes, key_sizes, sizes, min_time, log)
+    if streams:
+        results['streams'] = _bench_streams(modes, key_sizes, sizes, min_time, log)
+    return results
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = 'python -m pyaes.benchmark', description = 'Benchmarks pyaes, writing the results as JSON.')
+    parser.add_argument('--output', '-o', help = 'file to write the JSON results to (default: standard output)')
+    parser.add_argument('--modes', default = ','.join(MODES), help = 'comma-separated modes (also cfb8 and gcm; default: %(default)s)')
+    parser.add_argument('--key-bits', default = '128,192,256', help = 'comma-separated key sizes (default: %(default)s)')
+    parser.add_argument('--sizes', help = 'comma-separated payload sizes in bytes (default: 16 B to 16 MB)')
+    parser.add_argument('--quick', action = 'store_true', help = 'only payloads up to %d bytes' % QUICK_SIZES[-1])
+    parser.add_argument('--no-streams', action = 'store_true', help = 'skip encrypt_stream and decrypt_stream')
+    parser.add_argument('--min-time', type = float, default = 0.2, help = 'seconds to repeat each measurement for (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    modes = args.modes.split(',')
+    for name in modes:
+        if name not in AESModesOfOperation and name != 'cfb8':
+            parser.error('unknown mode: %s' % name)
+
+    key_sizes = [ int(bits) // 8 for bits in args.key_bits.split(',') ]
+    if args.sizes:
+        sizes = [ int(size) for size in args.sizes.split(',') ]
+    elif args.quick:
+        sizes = QUICK_SIZES
+    else:
+        sizes = PAYLOAD_SIZES
+
+    # Only block-sized payloads can be used with every mode
+    for size in sizes:
+        if size % 16:
+            parser.error('payload sizes must be multiples of 16 bytes')
+
+    log = lambda line: sys.stderr.write(line + '\n')
+    results = run(modes, key_sizes, sizes, not args.no_streams, args.min_time, log)
+
+    text = json.dumps(results, indent = 2, sort_keys = True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Richard Moore
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# An experimental bitsliced implementation of AES encryption for many
+# independent blocks, using nothing but Python integers.
+#
+# The state of N blocks is held in 8 integers ("planes") of 16 * N bits;
+# plane k holds bit k of every byte of every block. Bits N * p to N * (p + 1)
+# of a plane (chunk p) belong to byte p of the AES state, one bit per block.
+# Each boolean operation on a plane then works on all 16 * N bytes at once:
+#
+#   SubBytes      the 113 gate S-box circuit of Boyar and Peralta (see "A
+#                 depth-16 circuit for the AES S-box", 2011), evaluated once
+#   ShiftRows     masked rotations of the chunks of each plane
+#   MixColumns    xtime() is a renaming of the planes plus three XORs
+#   AddRoundKey   each key bit is a chunk of all zeros or all ones
+#
+# Converting to and from planes is done with stepped slices and an 8 x 8 bit
+# matrix transpose applied to the whole batch as one integer.
+#
+# This module is only shipped with the server (it requires Python 3).
+
+
+import collections
+import threading
+
+
+__all__ = ["encrypt_blocks"]
+
+
+# Blocks per pass; the work per block keeps falling up to about 8192 blocks,
+# while the memory used by each plane grows with it
+BATCH_SIZE = 4096
+
+
+# Masks for a batch of N blocks, keyed by N; each takes about 70 bytes per
+# block, so only the most recently used few are kept
+MASKS_CACHE_SIZE = 8
+
+_masks = collections.OrderedDict()
+_masks_lock = threading.Lock()
+
+def _get_masks(count):
+    with _masks_lock:
+        masks = _masks.get(count)
+        if masks is not None:
+            _masks.move_to_end(count)
+            return masks
+
+    chunk = (1 << count) - 1
+    ones = (1 << (16 * count)) - 1
+
+    # Chunks 4 * c + r for each row r
+    rows = [ sum(chunk << (count * (4 * c + r)) for c in range(4)) for r in range(4) ]
+
+    # Destination chunks when rotating rows within a column by k (from
+    # above, and wrapping around from below)
+    rotate = [ None ]
+    for k in range(1, 4):
+        rotate.append((sum(rows[r] for r in range(4 - k)), sum(rows[r] for r in range(4 - k, 4))))
+
+    # Delta-swap masks for transposing every 8 x 8 bit matrix (Hacker's
+    # Delight, section 7-3), repeated over the 128 * N bits of a batch
+    repeat = 2 * count
+    transpose = [ int.from_bytes(bytes.fromhex(m) * repeat, 'big') for m in
+                  ('00AA00AA00AA00AA', '0000CCCC0000CCCC', '00000000F0F0F0F0') ]
+
+    masks = (chunk, ones, rows, rotate, transpose)
+
+    with _masks_lock:
+        _masks[count] = masks
+        while len(_masks) > MASKS_CACHE_SIZE:
+            _masks.popitem(last = False)
+    return masks
+
+
+def _transpose(x, transpose):
+    (m1, m2, m3) = transpose
+    t = (x ^ (x >> 7)) & m1
+    x ^= t ^ (t << 7)
+    t = (x ^ (x >> 14)) & m2
+    x ^= t ^ (t << 14)
+    t = (x ^ (x >> 28)) & m3
+    return x ^ t ^ (t << 28)
+
+
+def _to_planes(data, count, masks):
+    'Splits count blocks into the 8 planes of bits, bit 0 first.'
+
+    # Gather byte p of every block, chunk 15 first (ie. most significant)
+    data = b''.join(data[p::16] for p in range(15, -1, -1))
+
+    # Each group of 8 bytes becomes 8 bytes of bits: bits 7, 6, ... 0
+    x = _transpose(int.from_bytes(data, 'big'), masks[4])
+    data = x.to_bytes(16 * count, 'big')
+
+    return [ int.from_bytes(data[7 - k::8], 'big') for k in range(8) ]
+
+
+def _from_planes(planes, count, masks):
+    'Joins the 8 planes of bits back into count blocks; see _to_planes.'
+
+    size = 2 * count
+    data = bytearray(16 * count)
+    for k in range(8):
+        data[7 - k::8] = planes[k].to_bytes(size, 'big')
+
+    x = _transpose(int.from_bytes(data, 'big'), masks[4])
+    data = x.to_bytes(16 * count, 'big')
+
+    result = bytearray(16 * count)
+    for p in range(16):
+        result[p::16] = data[(15 - p) * count:(16 - p) * count]
+    return bytes(result)
+
+
+def _key_planes(Ke, count, masks):
+    'Expands each round key into 8 planes of all-zero or all-one chunks.'
+
+    chunk = masks[0]
+    result = [ ]
+    for round_key in Ke:
+        key = b''.join(w.to_bytes(4, 'big') for w in round_key)
+        result.append([ sum(chunk << (count * p) for p in range(16) if (key[p] >> k) & 1) for k in range(8) ])
+    return result
+
+
+def _sub_bytes(planes, ones):
+    'The S-box circuit of Boyar and Peralta, applied to every byte at once.'
+
+    (x7, x6, x5, x4, x3, x2, x1, x0) = planes
+
+    # Top linear transformation
+    y14 = x3 ^ x5
+    y13 = x0 ^ x6
+    y9 = x0 ^ x3
+    y8 = x0 ^ x5
+    t0 = x1 ^ x2
+    y1 = t0 ^ x7
+    y4 = y1 ^ x3
+    y12 = y13 ^ y14
+    y2 = y1 ^ x0
+    y5 = y1 ^ x6
+    y3 = y5 ^ y8
+    t1 = x4 ^ y12
+    y15 = t1 ^ x5
+    y20 = t1 ^ x1
+    y6 = y15 ^ x7
+    y10 = y15 ^ t0
+    y11 = y20 ^ y9
+    y7 = x7 ^ y11
+    y17 = y10 ^ y11
+    y19 = y10 ^ y8
+    y16 = t0 ^ y11
+    y21 = y13 ^ y16
+    y18 = x0 ^ y16
+
+    # Non-linear section (inversion in GF(2^8))
+    t2 = y12 & y15
+    t3 = y3 & y6
+    t4 = t3 ^ t2
+    t5 = y4 & x7
+    t6 = t5 ^ t2
+    t7 = y13 & y16
+    t8 = y5 & y1
+    t9 = t8 ^ t7
+    t10 = y2 & y7
+    t11 = t10 ^ t7
+    t12 = y9 & y11
+    t13 = y14 & y17
+    t14 = t13 ^ t12
+    t15 = y8 & y10
+    t16 = t15 ^ t12
+    t17 = t4 ^ t14
+    t18 = t6 ^ t16
+    t19 = t9 ^ t14
+    t20 = t11 ^ t16
+    t21 = t17 ^ y20
+    t22 = t18 ^ y19
+    t23 = t19 ^ y21
+    t24 = t20 ^ y18
+
+    t25 = t21 ^ t22
+    t26 = t21 & t23
+    t27 = t24 ^ t26
+    t28 = t25 & t27
+    t29 = t28 ^ t22
+    t30 = t23 ^ t24
+    t31 = t22 ^ t26
+    t32 = t31 & t30
+    t33 = t32 ^ t24
+    t34 = t23 ^ t33
+    t35 = t27 ^ t33
+    t36 = t24 & t35
+    t37 = t36 ^ t34
+    t38 = t27 ^ t36
+    t39 = t29 & t38
+    t40 = t25 ^ t39
+
+    t41 = t40 ^ t37
+    t42 = t29 ^ t33
+    t43 = t29 ^ t40
+    t44 = t33 ^ t37
+    t45 = t42 ^ t41
+    z0 = t44 & y15
+    z1 = t37 & y6
+    z2 = t33 & x7
+    z3 = t43 & y16
+    z4 = t40 & y1
+    z5 = t29 & y7
+    z6 = t42 & y11
+    z7 = t45 & y17
+    z8 = t41 & y10
+    z9 = t44 & y12
+    z10 = t37 & y3
+    z11 = t33 & y4
+    z12 = t43 & y13
+    z13 = t40 & y5
+    z14 = t29 & y2
+    z15 = t42 & y9
+    z16 = t45 & y14
+    z17 = t41 & y8
+
+    # Bottom linear transformation (Python integers are signed, so NOT is
+    # an XOR with a mask of ones)
+    t46 = z15 ^ z16
+    t47 = z10 ^ z11
+    t48 = z5 ^ z13
+    t49 = z9 ^ z10
+    t50 = z2 ^ z12
+    t51 = z2 ^ z5
+    t52 = z7 ^ z8
+    t53 = z0 ^ z3
+    t54 = z6 ^ z7
+    t55 = z16 ^ z17
+    t56 = z12 ^ t48
+    t57 = t50 ^ t53
+    t58 = z4 ^ t46
+    t59 = z3 ^ t54
+    t60 = t46 ^ t57
+    t61 = z14 ^ t57
+    t62 = t52 ^ t58
+    t63 = t49 ^ t58
+    t64 = z4 ^ t59
+    t65 = t61 ^ t62
+    t66 = z1 ^ t63
+    s0 = t59 ^ t63
+    s6 = t56 ^ t62 ^ ones
+    s7 = t48 ^ t60 ^ ones
+    t67 = t64 ^ t65
+    s3 = t53 ^ t66
+    s4 = t51 ^ t66
+    s5 = t47 ^ t65
+    s1 = t64 ^ s3 ^ ones
+    s2 = t55 ^ t67 ^ ones
+
+    return [ s7, s6, s5, s4, s3, s2, s1, s0 ]
+
+
+def _encrypt_batch(data, count, Ke):
+    masks = _get_masks(count)
+    (chunk, ones, rows, rotate, transpose) = masks
+    (row0, row1, row2, row3) = rows
+    size = 16 * count
+
+    # ShiftRows rotates row r left by r columns; ie. the whole plane right
+    # by 4 * r chunks (wrapping around)
+    shift1 = 4 * count
+    shift2 = 8 * count
+    shift3 = 12 * count
+
+    # MixColumns needs rows rotated within their column by 1 and 2 chunks
+    ((down1, up1), (down2, up2)) = (rotate[1], rotate[2])
+    (n1, n2, n3) = (count, 2 * count, 3 * count)
+
+    key_planes = _key_planes(Ke, count, masks)
+    planes = [ p ^ k for (p, k) in zip(_to_planes(data, count, masks), key_planes[0]) ]
+
+    last = len(key_planes) - 1
+    for r in range(1, last + 1):
+        planes = _sub_bytes(planes, ones)
+
+        # ShiftRows
+        shifted = [ ]
+        for x in planes:
+            x1 = x & row1
+            x2 = x & row2
+            x3 = x & row3
+            shifted.append((x & row0) |
+                           (((x1 >> shift1) | (x1 << (size - shift1))) & row1) |
+                           (((x2 >> shift2) | (x2 << (size - shift2))) & row2) |
+                           (((x3 >> shift3) | (x3 << (size - shift3))) & row3))
+
+        round_key = key_planes[r]
+        if r == last:
+            planes = [ x ^ k for (x, k) in zip(shifted, round_key) ]
+            break
+
+        # MixColumns: each byte a[r] becomes
+        #   xtime(a[r] ^ a[r + 1]) ^ a[r + 1] ^ a[r + 2] ^ a[r + 3]
+        a1 = [ ((x >> n1) & down1) | ((x << n3) & up1) for x in shifted ]
+        t = [ x ^ y for (x, y) in zip(shifted, a1) ]
+        t2 = [ ((x >> n2) & down2) | ((x << n2) & up2) for x in t ]
+
+        (b0, b1, b2, b3, b4, b5, b6, b7) = t
+        xtime = (b7, b0 ^ b7, b1, b2 ^ b7, b3 ^ b7, b4, b5, b6)
+
+        planes = [ x ^ y ^ z ^ k for (x, y, z, k) in zip(xtime, a1, t2, round_key) ]
+
+    return _from_planes(planes, count, masks)
+
+
+def encrypt_blocks(aes, blocks):
+    '''Encrypts every 16 byte block of the bytes blocks with the key schedule
+       of aes (an AES object), returning the encrypted bytes.'''
+
+    blocks = bytes(blocks)
+    if len(blocks) % 16:
+        raise ValueError('blocks must be a multiple of 16 bytes')
+
+    Ke = aes._Ke
+
+    result = [ ]
+    step = 16 * BATCH_SIZE
+    for i in range(0, len(blocks), step):
+        batch = blocks[i:i + step]
+
+        # The transposition works on groups of 8 blocks
+        count = len(batch) // 16
+        padding = -count % 8
+        encrypted = _encrypt_batch(batch + bytes(16 * padding), count + padding, Ke)
+        result.append(encrypted[:16 * count])
+
+    return b''.join(result)
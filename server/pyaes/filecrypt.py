@@ -0,0 +1,235 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Richard Moore
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Encrypting (and decrypting) whole files with AES-CTR, on every core.
+#
+# CTR blocks are independent, so the input is memory-mapped and split into
+# chunks, and each chunk is encrypted by a process of a pool, seeking to its
+# own offset of the keystream. Each process maps the input and the output
+# file (created at its final size first) itself, so only offsets are sent
+# between the processes, never data. The output is raw CTR: the same size as
+# the input, with no header; the key and counter are needed to decrypt it.
+#
+# Usage (from the server directory):
+#
+#   python -m pyaes encrypt --key HEX [--counter HEX | --nonce HEX] INPUT OUTPUT
+#   python -m pyaes decrypt --key HEX [--counter HEX | --nonce HEX] INPUT OUTPUT
+#
+# A key and counter must never be used for more than one file.
+#
+# This module is only shipped with the server; it only needs the standard
+# library.
+
+
+import argparse
+import binascii
+import mmap
+import os
+import sys
+import time
+
+import concurrent.futures
+
+from . import aes
+from .aes import AESModeOfOperationCTR, Counter
+
+
+__all__ = ["crypt_file"]
+
+
+# Bytes of the file given to each task, and encrypted at a time within one
+CHUNK_SIZE = (1 << 24)
+PIECE_SIZE = (1 << 18)
+
+
+def _create_mode(key, initial_value, nonce):
+    return AESModeOfOperationCTR(key, Counter(initial_value, nonce))
+
+def _init_worker():
+    # The pool is already one process per core; a mode of operation should
+    # not split its own blocks between the processes of another
+    aes.AESBlockModeOfOperation.parallel_threshold = None
+
+def _crypt_chunk(input_path, output_path, key, initial_value, nonce, offset, length):
+    '''Encrypts (or decrypts) length bytes at offset of the input file into
+       the same bytes of the output file, returning length.'''
+
+    mode = _create_mode(key, initial_value, nonce)
+    mode.seek(offset)
+
+    with open(input_path, 'rb') as f:
+        source = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    try:
+        with open(output_path, 'r+b') as f:
+            target = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_WRITE)
+        try:
+            (src, dst) = (memoryview(source), memoryview(target))
+            try:
+                for start in range(offset, offset + length, PIECE_SIZE):
+                    end = min(start + PIECE_SIZE, offset + length)
+                    mode.encrypt_into(src[start:end], dst[start:end])
+            finally:
+                src.release()
+                dst.release()
+            target.flush()
+        finally:
+            target.close()
+    finally:
+        source.close()
+
+    return length
+
+
+def crypt_file(input_path, output_path, key, initial_value = 1, nonce = None, jobs = None, chunk_size = CHUNK_SIZE, progress = None):
+    '''Encrypts (or, as CTR is symmetric, decrypts) the file input_path to
+       output_path, with the counter Counter(initial_value, nonce), split
+       into chunks of chunk_size bytes between jobs processes (None for one
+       per CPU). progress, if given, is called with the bytes done so far
+       and the total after each chunk. Returns the number of bytes.'''
+
+    if len(key) not in (16, 24, 32):
+        raise ValueError('Invalid key size')
+    if chunk_size <= 0 or chunk_size % 16:
+        raise ValueError('chunk size must be a positive multiple of 16 bytes')
+
+    size = os.path.getsize(input_path)
+
+    # Check the counter before creating the output; a counter that wraps
+    # would reuse keystream (the nonce layout only has 32 bits of counter)
+    _create_mode(key, initial_value, nonce)
+    limit = (nonce is None) and (1 << 128) or (1 << 32)
+    if initial_value < 0 or initial_value + (size + 15) // 16 > limit:
+        raise ValueError('file too large for the counter: %d bytes from initial value %d would wrap it' % (size, initial_value))
+
+    # Preallocate the output, so each chunk can be mapped and written in place
+    with open(output_path, 'wb') as f:
+        f.truncate(size)
+    if size == 0:
+        return 0
+
+    chunks = [ (offset, min(chunk_size, size - offset)) for offset in range(0, size, chunk_size) ]
+    if jobs is None:
+        jobs = aes._cpu_count()
+    jobs = max(1, min(jobs, len(chunks)))
+
+    done = 0
+    if jobs == 1:
+        for (offset, length) in chunks:
+            done += _crypt_chunk(input_path, output_path, key, initial_value, nonce, offset, length)
+            if progress is not None:
+                progress(done, size)
+
+    else:
+        with concurrent.futures.ProcessPoolExecutor(jobs, initializer = _init_worker) as pool:
+            results = [ pool.submit(_crypt_chunk, input_path, output_path, key, initial_value, nonce, offset, length)
+                        for (offset, length) in chunks ]
+            try:
+                for result in concurrent.futures.as_completed(results):
+                    done += result.result()
+                    if progress is not None:
+                        progress(done, size)
+            except BaseException:
+                for result in results:
+                    result.cancel()
+                raise
+
+    return size
+
+
+def _hex_bytes(text):
+    try:
+        return binascii.unhexlify(text.strip())
+    except (binascii.Error, TypeError):
+        raise argparse.ArgumentTypeError('not a hexadecimal string: %r' % text)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog = 'python -m pyaes', description = 'Encrypts or decrypts a file with AES-CTR, on every core.')
+    parser.add_argument('command', choices = ('encrypt', 'decrypt'))
+    parser.add_argument('input', help = 'file to read')
+    parser.add_argument('output', help = 'file to write (replaced)')
+
+    keys = parser.add_mutually_exclusive_group(required = True)
+    keys.add_argument('--key', type = _hex_bytes, help = 'the key, in hexadecimal (16, 24 or 32 bytes)')
+    keys.add_argument('--key-file', help = 'file holding the raw key')
+
+    counters = parser.add_mutually_exclusive_group()
+    counters.add_argument('--counter', type = _hex_bytes, help = 'the initial counter block, in hexadecimal (16 bytes; default: 1)')
+    counters.add_argument('--nonce', type = _hex_bytes, help = 'a 12 byte nonce, in hexadecimal, followed by a 32-bit block counter starting at 1')
+
+    parser.add_argument('--jobs', '-j', type = int, help = 'processes to use (default: one per CPU)')
+    parser.add_argument('--chunk-size', type = int, default = CHUNK_SIZE // (1 << 20), help = 'MB of the file per task (default: %(default)s)')
+    parser.add_argument('--quiet', '-q', action = 'store_true', help = 'no progress or summary')
+    args = parser.parse_args(argv)
+
+    key = args.key
+    if args.key_file:
+        with open(args.key_file, 'rb') as f:
+            key = f.read()
+    if len(key) not in (16, 24, 32):
+        parser.error('the key must be 16, 24 or 32 bytes')
+
+    (initial_value, nonce) = (1, None)
+    if args.counter is not None:
+        if len(args.counter) != 16:
+            parser.error('the counter must be 16 bytes')
+        initial_value = int(binascii.hexlify(args.counter), 16)
+    elif args.nonce is not None:
+        if len(args.nonce) != 12:
+            parser.error('the nonce must be 12 bytes')
+        nonce = args.nonce
+
+    if args.jobs is not None and args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.chunk_size < 1:
+        parser.error('--chunk-size must be at least 1')
+
+    if os.path.abspath(args.input) == os.path.abspath(args.output):
+        parser.error('the input and output must be different files')
+
+    start = time.perf_counter()
+    progress = None
+    if not args.quiet and sys.stderr.isatty():
+        def progress(done, total):
+            elapsed = time.perf_counter() - start
+            rate = done / max(elapsed, 1e-9) / 1e6
+            sys.stderr.write('\r%5.1f%%  %d / %d bytes  %.1f MB/s' % (100.0 * done / total, done, total, rate))
+            sys.stderr.flush()
+
+    jobs = args.jobs or aes._cpu_count()
+    try:
+        size = crypt_file(args.input, args.output, key, initial_value, nonce, jobs, args.chunk_size << 20, progress)
+    except (IOError, OSError, ValueError) as e:
+        if progress is not None:
+            sys.stderr.write('\n')
+        sys.stderr.write('%s: %s\n' % (parser.prog, e))
+        return 1
+
+    elapsed = time.perf_counter() - start
+    if not args.quiet:
+        if progress is not None:
+            sys.stderr.write('\n')
+        sys.stderr.write('%sed %d bytes in %.2f s (%.1f MB/s, %d process%s)\n' % (
+            args.command, size, elapsed, size / max(elapsed, 1e-9) / 1e6, jobs, (jobs != 1) and 'es' or ''))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,215 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Richard Moore
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# A block cipher backend using the AES ECB ciphers of OpenSSL's libcrypto
+# through ctypes (the EVP interface), which use AES-NI where available.
+#
+# The modes of operation are still those of aes.py; only the block cipher is
+# replaced, so the output is identical to the pure-Python engine. The CTR
+# keystream for a run of counter blocks is produced in a single EVP call of
+# libcrypto's own CTR mode, as is ECB encrypt_blocks (and CBC encryption of
+# many blocks, with its CBC mode).
+#
+# This module is only shipped with the server. The library is loaded when
+# the first LibcryptoAES is created, which raises an OSError if it cannot
+# be found (or lacks a function used here); aes.py then falls back to the
+# pure-Python engine.
+
+
+import ctypes
+import ctypes.util
+
+__all__ = ["LibcryptoAES"]
+
+
+# Largest input handed to a single EVP_*Update call (its length is an int)
+MAX_UPDATE = 1 << 30
+
+_library = None
+
+def _load():
+    global _library
+    if _library is None:
+        name = ctypes.util.find_library('crypto')
+        if name is None:
+            raise OSError('libcrypto not found')
+        library = ctypes.CDLL(name)
+
+        # Old or stripped builds (and some LibreSSL versions) may lack a
+        # symbol; such a library is unavailable, like a missing one
+        try:
+            library.EVP_CIPHER_CTX_new.restype = ctypes.c_void_p
+            library.EVP_CIPHER_CTX_new.argtypes = [ ]
+            library.EVP_CIPHER_CTX_free.restype = None
+            library.EVP_CIPHER_CTX_free.argtypes = [ ctypes.c_void_p ]
+            library.EVP_CIPHER_CTX_set_padding.argtypes = [ ctypes.c_void_p, ctypes.c_int ]
+
+            for bits in (128, 192, 256):
+                for mode in ('ecb', 'ctr', 'cbc'):
+                    function = getattr(library, 'EVP_aes_%d_%s' % (bits, mode))
+                    function.restype = ctypes.c_void_p
+                    function.argtypes = [ ]
+
+            for name in ('EVP_EncryptInit_ex', 'EVP_DecryptInit_ex'):
+                getattr(library, name).argtypes = [ ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p ]
+
+            for name in ('EVP_EncryptUpdate', 'EVP_DecryptUpdate'):
+                getattr(library, name).argtypes = [ ctypes.c_void_p, ctypes.c_void_p, ctypes.POINTER(ctypes.c_int), ctypes.c_void_p, ctypes.c_int ]
+        except AttributeError as e:
+            raise OSError('libcrypto is missing a function: %s' % e)
+
+        _library = library
+    return _library
+
+
+class _Context(object):
+    '''An EVP cipher context for one key, mode and direction, without
+       padding.'''
+
+    def __init__(self, library, key, encrypt, mode = 'ecb'):
+        self._library = library
+        self._ctx = library.EVP_CIPHER_CTX_new()
+        if not self._ctx:
+            raise MemoryError('EVP_CIPHER_CTX_new failed')
+
+        cipher = getattr(library, 'EVP_aes_%d_%s' % (8 * len(key), mode))()
+        if encrypt:
+            (init, self._update) = (library.EVP_EncryptInit_ex, library.EVP_EncryptUpdate)
+        else:
+            (init, self._update) = (library.EVP_DecryptInit_ex, library.EVP_DecryptUpdate)
+
+        if init(self._ctx, cipher, None, key, None) != 1:
+            raise ValueError('EVP cipher initialization failed')
+        library.EVP_CIPHER_CTX_set_padding(self._ctx, 0)
+
+        self._length = ctypes.c_int()
+
+    def __del__(self):
+        ctx = getattr(self, '_ctx', None)
+        if ctx:
+            self._library.EVP_CIPHER_CTX_free(ctx)
+
+    def set_iv(self, iv):
+        if self._library.EVP_EncryptInit_ex(self._ctx, None, None, None, iv) != 1:
+            raise ValueError('EVP cipher initialization failed')
+
+    def update(self, data):
+        '''Returns data encrypted (or decrypted); if data is an int, it is
+           the length of a string of zero bytes to encrypt.'''
+
+        if isinstance(data, int):
+            (size, data) = (data, None)
+        else:
+            size = len(data)
+
+        result = ctypes.create_string_buffer(size)
+        (address, length) = (ctypes.addressof(result), self._length)
+        for i in range(0, size, MAX_UPDATE):
+            if data is None:
+                # The zero bytes are already in result; encrypt in place
+                (chunk, chunk_size) = (address + i, min(MAX_UPDATE, size - i))
+            else:
+                chunk = data[i:i + MAX_UPDATE]
+                chunk_size = len(chunk)
+            if self._update(self._ctx, address + i, ctypes.byref(length), chunk, chunk_size) != 1:
+                raise ValueError('EVP cipher update failed')
+        return result.raw
+
+
+class LibcryptoAES(object):
+    '''The AES block cipher from libcrypto, with the same encrypt and decrypt
+       as AES plus encrypt_blocks and decrypt_blocks for any number of
+       blocks.
+
+       Each object holds its own EVP contexts, so (like a mode of operation)
+       it must not be shared between threads.'''
+
+    def __init__(self, key):
+        if len(key) not in (16, 24, 32):
+            raise ValueError('Invalid key size')
+
+        self._library = _load()
+        self._key = bytes(key)
+        self._encrypt = _Context(self._library, self._key, True)
+        self._decrypt = None
+        self._ctr = None
+        self._cbc = None
+
+    def encrypt(self, plaintext):
+        'Encrypt a block of plain text using the AES block cipher.'
+
+        if len(plaintext) != 16:
+            raise ValueError('wrong block length')
+
+        return self._encrypt.update(bytes(plaintext))
+
+    def decrypt(self, ciphertext):
+        'Decrypt a block of cipher text using the AES block cipher.'
+
+        if len(ciphertext) != 16:
+            raise ValueError('wrong block length')
+
+        return self.decrypt_blocks(ciphertext)
+
+    def encrypt_blocks(self, blocks):
+        'Encrypts a string of any number of 16 byte blocks.'
+
+        if len(blocks) % 16:
+            raise ValueError('blocks must be a multiple of 16 bytes')
+
+        return self._encrypt.update(bytes(blocks))
+
+    def decrypt_blocks(self, blocks):
+        'Decrypts a string of any number of 16 byte blocks.'
+
+        if len(blocks) % 16:
+            raise ValueError('blocks must be a multiple of 16 bytes')
+
+        # Like the pure-Python engine, only set up decryption once needed
+        if self._decrypt is None:
+            self._decrypt = _Context(self._library, self._key, False)
+
+        return self._decrypt.update(bytes(blocks))
+
+    def ctr_keystream(self, start, count):
+        '''Returns the CTR keystream for count counter blocks, starting at
+           the counter block start (16 bytes) and incrementing it as a
+           128-bit big-endian integer.'''
+
+        if self._ctr is None:
+            self._ctr = _Context(self._library, self._key, True, 'ctr')
+
+        self._ctr.set_iv(start)
+        return self._ctr.update(16 * count)
+
+    def cbc_encrypt(self, iv, blocks):
+        '''Returns blocks (any number of 16 byte blocks) encrypted in CBC
+           mode, chained from iv (16 bytes).'''
+
+        if len(blocks) % 16:
+            raise ValueError('blocks must be a multiple of 16 bytes')
+
+        if self._cbc is None:
+            self._cbc = _Context(self._library, self._key, True, 'cbc')
+
+        self._cbc.set_iv(bytes(iv))
+        return self._cbc.update(bytes(blocks))
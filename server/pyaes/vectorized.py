@@ -0,0 +1,96 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Richard Moore
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# A NumPy implementation of AES encryption for many independent blocks.
+#
+# Each round is the same four column expressions as AESUnrolled, but every
+# state word is a column vector of N words, so one table gather handles all
+# N blocks. This only pays off for modes whose blocks do not depend on each
+# other (ie. the CTR keystream), and only for more than a few dozen blocks.
+#
+# This module is only shipped with the server; importing it raises an
+# ImportError when NumPy is not installed, which aes.py relies on.
+
+
+import numpy
+
+__all__ = ["encrypt_blocks"]
+
+
+# Blocks per pass; bounds the size of the temporary arrays
+BATCH_SIZE = 4096
+
+_tables = None
+
+def _get_tables(aes):
+    global _tables
+    if _tables is None:
+        _tables = tuple(numpy.array(t, dtype = numpy.uint32) for t in (aes.T1, aes.T2, aes.T3, aes.T4, aes.S))
+    return _tables
+
+
+def _encrypt_batch(tables, Ke, blocks):
+    (T1, T2, T3, T4, S) = tables
+
+    # Convert the blocks to (big-endian words ^ key), one column per word
+    words = blocks.view('>u4').astype(numpy.uint32) ^ Ke[0]
+    (s0, s1, s2, s3) = (words[:, 0], words[:, 1], words[:, 2], words[:, 3])
+
+    # Apply round transforms
+    for (k0, k1, k2, k3) in Ke[1:-1]:
+        t0 = T1[s0 >> 24] ^ T2[(s1 >> 16) & 0xFF] ^ T3[(s2 >> 8) & 0xFF] ^ T4[s3 & 0xFF] ^ k0
+        t1 = T1[s1 >> 24] ^ T2[(s2 >> 16) & 0xFF] ^ T3[(s3 >> 8) & 0xFF] ^ T4[s0 & 0xFF] ^ k1
+        t2 = T1[s2 >> 24] ^ T2[(s3 >> 16) & 0xFF] ^ T3[(s0 >> 8) & 0xFF] ^ T4[s1 & 0xFF] ^ k2
+        s3 = T1[s3 >> 24] ^ T2[(s0 >> 16) & 0xFF] ^ T3[(s1 >> 8) & 0xFF] ^ T4[s2 & 0xFF] ^ k3
+        (s0, s1, s2) = (t0, t1, t2)
+
+    # The last round is special
+    (k0, k1, k2, k3) = Ke[-1]
+    result = numpy.empty((len(blocks), 4), dtype = '>u4')
+    result[:, 0] = ((S[s0 >> 24] << 24) | (S[(s1 >> 16) & 0xFF] << 16) | (S[(s2 >> 8) & 0xFF] << 8) | S[s3 & 0xFF]) ^ k0
+    result[:, 1] = ((S[s1 >> 24] << 24) | (S[(s2 >> 16) & 0xFF] << 16) | (S[(s3 >> 8) & 0xFF] << 8) | S[s0 & 0xFF]) ^ k1
+    result[:, 2] = ((S[s2 >> 24] << 24) | (S[(s3 >> 16) & 0xFF] << 16) | (S[(s0 >> 8) & 0xFF] << 8) | S[s1 & 0xFF]) ^ k2
+    result[:, 3] = ((S[s3 >> 24] << 24) | (S[(s0 >> 16) & 0xFF] << 16) | (S[(s1 >> 8) & 0xFF] << 8) | S[s2 & 0xFF]) ^ k3
+
+    return result.view(numpy.uint8)
+
+
+def encrypt_blocks(aes, blocks):
+    '''Encrypts every row of an (N, 16) array of bytes (or every block of a
+       string of N * 16 bytes) with the key schedule of aes (an AES object),
+       returning a new (N, 16) uint8 array.'''
+
+    if isinstance(blocks, bytes):
+        blocks = numpy.frombuffer(blocks, dtype = numpy.uint8).reshape(-1, 16)
+
+    blocks = numpy.ascontiguousarray(blocks, dtype = numpy.uint8)
+    if blocks.ndim != 2 or blocks.shape[1] != 16:
+        raise ValueError('blocks must be an (N, 16) array')
+
+    tables = _get_tables(aes)
+    Ke = numpy.array(aes._Ke, dtype = numpy.uint32)
+
+    result = numpy.empty(blocks.shape, dtype = numpy.uint8)
+    for i in range(0, len(blocks), BATCH_SIZE):
+        result[i:i + BATCH_SIZE] = _encrypt_batch(tables, Ke, blocks[i:i + BATCH_SIZE])
+
+    return result
@@ -0,0 +1,971 @@
+# Tests for pyaes: known-answer tests where there are published vectors,
+# and round trips or comparisons with the table-driven engine otherwise.
+# Tests of optional engines and backends are skipped if they are not
+# available.
+#
+# Run from the server directory, with "python -m unittest test_pyaes" (or
+# pytest).
+
+import asyncio
+import binascii
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+from unittest import mock
+
+from io import BytesIO
+
+import pyaes
+from pyaes import aes
+
+
+def _unhex(text):
+    return binascii.unhexlify(text.replace(' ', ''))
+
+# The table-driven engines return blocks as lists of ints
+def _encrypt(engine, block):
+    return bytes(bytearray(engine.encrypt(block)))
+
+def _decrypt(engine, block):
+    return bytes(bytearray(engine.decrypt(block)))
+
+def _encrypt_all(engine, blocks):
+    return b''.join([ _encrypt(engine, blocks[i:i + 16]) for i in range(0, len(blocks), 16) ])
+
+
+# (key, plaintext, ciphertext)
+FIPS_197 = [
+    ('000102030405060708090a0b0c0d0e0f',
+     '00112233445566778899aabbccddeeff', '69c4e0d86a7b0430d8cdb78070b4c55a'),
+    ('000102030405060708090a0b0c0d0e0f1011121314151617',
+     '00112233445566778899aabbccddeeff', 'dda97ca4864cdfe06eaf70a0ec0d7191'),
+    ('000102030405060708090a0b0c0d0e0f101112131415161718191a1b1c1d1e1f',
+     '00112233445566778899aabbccddeeff', '8ea2b7ca516745bfeafc49904b496089'),
+]
+
+# NIST SP800-38A, F.5.1 (CTR-AES128.Encrypt)
+CTR_KEY = '2b7e151628aed2a6abf7158809cf4f3c'
+CTR_COUNTER = 'f0f1f2f3f4f5f6f7f8f9fafbfcfdfeff'
+CTR_PLAINTEXT = ('6bc1bee22e409f96e93d7e117393172aae2d8a571e03ac9c9eb76fac45af8e51'
+                 '30c81c46a35ce411e5fbc1191a0a52eff69f2445df4f9b17ad2b417be66c3710')
+CTR_CIPHERTEXT = ('874d6191b620e3261bef6864990db6ce9806f66b7970fdff8617187bb9fffdff'
+                  '5ae4df3edbd5d35e5b4f09020db03eab1e031dda2fbe03d1792170a0f3009cee')
+
+_GCM_KEY = 'feffe9928665731c6d6a8f9467308308'
+_GCM_PLAINTEXT = ('d9313225f88406e5a55909c5aff5269a86a7a9531534f7da2e4c303d8a318a72'
+                  '1c3c0c95956809532fcf0e2449a6b525b16aedf5aa0de657ba637b39')
+_GCM_AAD = 'feedfacedeadbeeffeedfacedeadbeefabaddad2'
+
+# (key, iv, plaintext, associated data, ciphertext, tag); test cases 1 - 6,
+# 10 and 16 of the GCM specification
+GCM = [
+    ('00000000000000000000000000000000', '000000000000000000000000', '', '',
+     '', '58e2fccefa7e3061367f1d57a4e7455a'),
+    ('00000000000000000000000000000000', '000000000000000000000000', '00000000000000000000000000000000', '',
+     '0388dace60b6a392f328c2b971b2fe78', 'ab6e47d42cec13bdf53a67b21257bddf'),
+    (_GCM_KEY, 'cafebabefacedbaddecaf888',
+     _GCM_PLAINTEXT + '1aafd255', '',
+     '42831ec2217774244b7221b784d0d49ce3aa212f2c02a4e035c17e2329aca12e'
+     '21d514b25466931c7d8f6a5aac84aa051ba30b396a0aac973d58e091473f5985',
+     '4d5c2af327cd64a62cf35abd2ba6fab4'),
+    (_GCM_KEY, 'cafebabefacedbaddecaf888', _GCM_PLAINTEXT, _GCM_AAD,
+     '42831ec2217774244b7221b784d0d49ce3aa212f2c02a4e035c17e2329aca12e'
+     '21d514b25466931c7d8f6a5aac84aa051ba30b396a0aac973d58e091',
+     '5bc94fbc3221a5db94fae95ae7121a47'),
+    (_GCM_KEY, 'cafebabefacedbad', _GCM_PLAINTEXT, _GCM_AAD,
+     '61353b4c2806934a777ff51fa22a4755699b2a714fcdc6f83766e5f97b6c7423'
+     '73806900e49f24b22b097544d4896b424989b5e1ebac0f07c23f4598',
+     '3612d2e79e3b0785561be14aaca2fccb'),
+    (_GCM_KEY, '9313225df88406e555909c5aff5269aa6a7a9538534f7da1e4c303d2a318a728'
+               'c3c0c95156809539fcf0e2429a6b525416aedbf5a0de6a57a637b39b',
+     _GCM_PLAINTEXT, _GCM_AAD,
+     '8ce24998625615b603a033aca13fb894be9112a5c3a211a8ba262a3cca7e2ca7'
+     '01e4a9a4fba43c90ccdcb281d48c7c6fd62875d2aca417034c34aee5',
+     '619cc5aefffe0bfa462af43c1699d050'),
+    (_GCM_KEY + 'feffe9928665731c', 'cafebabefacedbaddecaf888', _GCM_PLAINTEXT, _GCM_AAD,
+     '3980ca0b3c00e841eb06fac4872a2757859e1ceaa6efd984628593b40ca1e19c'
+     '7d773d00c144c525ac619d18c84a3f4718e2448b2fe324d9ccda2710',
+     '2519498e80f1478f37ba55bd6d27618c'),
+    (_GCM_KEY + _GCM_KEY, 'cafebabefacedbaddecaf888', _GCM_PLAINTEXT, _GCM_AAD,
+     '522dc1f099567d07f47f37a32a84427d643a8cdcbfe5c0c97598a2bd2555d1aa'
+     '8cb08e48590dbb3da7b08b1056828838c5f61e6393ba7a0abcc9f662',
+     '76fc6ece0f4e1768cddf8853bb2d551b'),
+]
+
+
+class AESTest(unittest.TestCase):
+
+    def test_fips_197(self):
+        for (key, plaintext, ciphertext) in FIPS_197:
+            (key, plaintext, ciphertext) = (_unhex(key), _unhex(plaintext), _unhex(ciphertext))
+            for engine in (aes.AES(key), aes.AESUnrolled(key)):
+                self.assertEqual(_encrypt(engine, plaintext), ciphertext)
+                self.assertEqual(_decrypt(engine, ciphertext), plaintext)
+
+
+class CounterTest(unittest.TestCase):
+
+    def test_nonce_wrap(self):
+        nonce = _unhex('0102030405060708090a0b0c')
+        counter = pyaes.Counter(0xfffffffe, nonce)
+
+        values = [ ]
+        for i in range(4):
+            values.append(counter.value)
+            counter.increment()
+        self.assertEqual(values, [ nonce + _unhex(v) for v in ('fffffffe', 'ffffffff', '00000000', '00000001') ])
+
+        # A run of counter blocks wraps the same way
+        self.assertEqual(pyaes.Counter(0xfffffffe, nonce).blocks(4), b''.join(values))
+
+        counter = pyaes.Counter(0xfffffffe, nonce)
+        counter.advance(3)
+        self.assertEqual(counter.value, values[3])
+
+    def test_full_wrap(self):
+        counter = pyaes.Counter((1 << 128) - 1)
+        self.assertEqual(counter.blocks(2), b'\xff' * 16 + b'\0' * 16)
+
+
+class CTRTest(unittest.TestCase):
+
+    def _mode(self):
+        counter = pyaes.Counter(int(CTR_COUNTER, 16))
+        return pyaes.AESModeOfOperationCTR(_unhex(CTR_KEY), counter)
+
+    def test_vector(self):
+        self.assertEqual(self._mode().encrypt(_unhex(CTR_PLAINTEXT)), _unhex(CTR_CIPHERTEXT))
+        self.assertEqual(self._mode().decrypt(_unhex(CTR_CIPHERTEXT)), _unhex(CTR_PLAINTEXT))
+
+    def test_seek(self):
+        (plaintext, ciphertext) = (_unhex(CTR_PLAINTEXT), _unhex(CTR_CIPHERTEXT))
+
+        # Every offset, with lengths within and across blocks
+        mode = self._mode()
+        for offset in range(len(plaintext)):
+            for end in (offset, offset + 1, offset + 17, len(plaintext)):
+                self.assertEqual(mode.encrypt_at(offset, plaintext[offset:end]), ciphertext[offset:end])
+                self.assertEqual(mode.decrypt_at(offset, ciphertext[offset:end]), plaintext[offset:end])
+
+        # Seeking backwards, then carrying on from there
+        mode.seek(5)
+        self.assertEqual(mode.encrypt(plaintext[5:9]) + mode.encrypt(plaintext[9:]), ciphertext[5:])
+
+        self.assertRaises(ValueError, mode.seek, -1)
+
+    def test_seek_custom_counter(self):
+        class Custom(pyaes.Counter):
+            def increment(self):
+                pyaes.Counter.increment(self)
+
+        mode = pyaes.AESModeOfOperationCTR(_unhex(CTR_KEY), Custom(int(CTR_COUNTER, 16)))
+        self.assertEqual(mode.encrypt_at(21, _unhex(CTR_PLAINTEXT)[21:]), _unhex(CTR_CIPHERTEXT)[21:])
+
+
+class IntoTest(unittest.TestCase):
+    'encrypt_into and decrypt_into against encrypt and decrypt.'
+
+    def setUp(self):
+        self.span = aes._INTO_SPAN
+        aes._INTO_SPAN = 64
+
+    def tearDown(self):
+        aes._INTO_SPAN = self.span
+
+    def _modes(self):
+        (key, iv) = (os.urandom(16), os.urandom(16))
+        return [
+            lambda: pyaes.AESModeOfOperationECB(key),
+            lambda: pyaes.AESModeOfOperationCBC(key, iv),
+            lambda: pyaes.AESModeOfOperationCFB(key, iv, 8),
+            lambda: pyaes.AESModeOfOperationOFB(key, iv),
+            lambda: pyaes.AESModeOfOperationCTR(key),
+        ]
+
+    def test_round_trip(self):
+        plaintext = os.urandom(16 * 21)
+        for create in self._modes():
+            mode = create()
+            ciphertext = getattr(mode, 'encrypt_blocks', mode.encrypt)(plaintext)
+
+            # Into a larger buffer, spanning several spans
+            buffer = bytearray(len(plaintext) + 16)
+            self.assertEqual(create().encrypt_into(plaintext, buffer), len(plaintext))
+            self.assertEqual(bytes(buffer[:len(plaintext)]), ciphertext)
+            self.assertEqual(bytes(buffer[len(plaintext):]), b'\0' * 16)
+
+            # In place, through a memoryview
+            buffer = bytearray(ciphertext)
+            create().decrypt_into(memoryview(buffer), buffer)
+            self.assertEqual(bytes(buffer), plaintext)
+
+    def test_errors(self):
+        for create in self._modes():
+            self.assertRaises(ValueError, create().encrypt_into, b'\0' * 32, bytearray(16))
+
+        mode = pyaes.AESModeOfOperationCBC(os.urandom(16))
+        self.assertRaises(ValueError, mode.encrypt_into, b'\0' * 17, bytearray(32))
+
+
+class EngineTest(unittest.TestCase):
+    'The batch engines and backends against the table-driven engine.'
+
+    def setUp(self):
+        self.blocks = os.urandom(16 * 97)
+
+    def _check_batch(self, encrypt_blocks):
+        for size in (16, 24, 32):
+            engine = aes.AES(os.urandom(size))
+            self.assertEqual(bytes(encrypt_blocks(engine, self.blocks)), _encrypt_all(engine, self.blocks))
+
+    def test_numpy(self):
+        if aes._vector_encrypt_blocks is None:
+            self.skipTest('NumPy is not available')
+        self._check_batch(lambda engine, blocks: aes._vector_encrypt_blocks(engine, blocks).tobytes())
+
+    def test_bitsliced(self):
+        if aes._bitsliced_encrypt_blocks is None:
+            self.skipTest('the bitsliced engine is not available')
+        self._check_batch(aes._bitsliced_encrypt_blocks)
+
+        # Only a few batch sizes keep their masks
+        from pyaes import bitsliced
+        engine = aes.AES(os.urandom(16))
+        for count in range(1, 200, 7):
+            self.assertEqual(bitsliced.encrypt_blocks(engine, self.blocks[:16 * count]), _encrypt_all(engine, self.blocks[:16 * count]))
+        self.assertTrue(len(bitsliced._masks) <= bitsliced.MASKS_CACHE_SIZE)
+
+    def test_modes(self):
+        'Every mode gives the same result with every engine in use.'
+
+        key = os.urandom(16)
+        data = os.urandom(1 << 16)
+        modes = aes.AESBlockModeOfOperation
+        thresholds = (modes.vector_threshold, modes.bitslice_threshold)
+
+        expected = None
+        for threshold in (1 << 62, 1024):
+            (modes.vector_threshold, modes.bitslice_threshold) = (threshold, threshold)
+            try:
+                results = dict(
+                    ecb = pyaes.AESModeOfOperationECB(key).encrypt_blocks(data),
+                    cbc = pyaes.AESModeOfOperationCBC(key, key).decrypt_blocks(data),
+                    ctr = pyaes.AESModeOfOperationCTR(key).encrypt(data),
+                    cfb = pyaes.AESModeOfOperationCFB(key, key, 16).decrypt(data),
+                )
+            finally:
+                (modes.vector_threshold, modes.bitslice_threshold) = thresholds
+            if expected is not None:
+                self.assertEqual(results, expected)
+            expected = results
+
+
+class KeyContextTest(unittest.TestCase):
+
+    def setUp(self):
+        (self.key, self.iv) = (os.urandom(32), os.urandom(16))
+        self.data = os.urandom(16 * 150)
+
+    def _crypt(self, key):
+        return [
+            pyaes.AESModeOfOperationECB(key).encrypt_blocks(self.data),
+            pyaes.AESModeOfOperationCBC(key, self.iv).decrypt_blocks(self.data),
+            pyaes.AESModeOfOperationOFB(key, self.iv).encrypt(self.data),
+            pyaes.AESModeOfOperationCTR(key).encrypt(self.data),
+            pyaes.AESModeOfOperationGCM(key, self.iv[:12]).encrypt_and_digest(self.data),
+        ]
+
+    def test_modes(self):
+        context = pyaes.KeyContext(self.key)
+        self.assertEqual(self._crypt(context), self._crypt(self.key))
+
+        # The modes only hold the state of their stream
+        self.assertFalse(hasattr(pyaes.AESModeOfOperationCTR(context), '__dict__'))
+
+    def test_immutable(self):
+        context = pyaes.KeyContext(self.key)
+        self.assertRaises(AttributeError, setattr, context, 'key', b'\0' * 16)
+        self.assertRaises(AttributeError, delattr, context, 'key')
+
+        copy = pickle.loads(pickle.dumps(context))
+        self.assertEqual(copy.key, self.key)
+        self.assertEqual(self._crypt(copy), self._crypt(self.key))
+
+    def test_threads(self):
+        context = pyaes.KeyContext(self.key)
+        counters = [ pyaes.Counter(i << 64) for i in range(8) ]
+        expected = [ pyaes.AESModeOfOperationCTR(self.key, pyaes.Counter(i << 64)).encrypt(self.data) for i in range(8) ]
+
+        results = [ None ] * 8
+        def run(i):
+            mode = pyaes.AESModeOfOperationCTR(context, counters[i])
+            results[i] = b''.join([ mode.encrypt(self.data[j:j + 100]) for j in range(0, len(self.data), 100) ])
+
+        threads = [ threading.Thread(target = run, args = (i, )) for i in range(8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, expected)
+
+
+class BlockMemoTest(unittest.TestCase):
+
+    def test_modes(self):
+        (key, iv) = (os.urandom(16), os.urandom(16))
+        blocks = [ os.urandom(16) for i in range(4) ]
+        data = b''.join([ blocks[i % 3] for i in range(60) ]) + blocks[3]
+
+        mode = pyaes.AESModeOfOperationECB(key, memo_bytes = 4096)
+        encrypted = mode.encrypt_blocks(data)
+        self.assertEqual(encrypted, pyaes.AESModeOfOperationECB(key).encrypt_blocks(data))
+        self.assertEqual(mode.decrypt_blocks(encrypted), data)
+        self.assertEqual(mode.encrypt(blocks[0]), encrypted[:16])
+        self.assertEqual((mode.encrypt_memo.misses, mode.encrypt_memo.hits), (4, 58))
+
+        encrypted = pyaes.AESModeOfOperationCBC(key, iv).encrypt_blocks(data)
+        mode = pyaes.AESModeOfOperationCBC(key, iv, memo_bytes = 4096)
+        self.assertEqual(mode.decrypt_blocks(encrypted[:160]) + mode.decrypt_blocks(encrypted[160:]), data)
+
+    def test_bound(self):
+        memo = pyaes.BlockMemo(max_bytes = 10 * pyaes.BlockMemo.entry_bytes)
+        encrypt = aes.AESUnrolled(os.urandom(16)).encrypt
+        blocks = [ os.urandom(16) for i in range(50) ]
+
+        for block in blocks:
+            self.assertEqual(memo.get(block, encrypt), encrypt(block))
+            self.assertTrue(len(memo) <= 10)
+        self.assertEqual(memo.misses, 50)
+        self.assertTrue(memo.evictions >= 40)
+
+        # A block used since the last turnover survives the next one
+        memo.get(blocks[-1], encrypt)
+        for block in blocks[:5]:
+            memo.get(block, encrypt)
+        hits = memo.hits
+        memo.get(blocks[-1], encrypt)
+        self.assertEqual(memo.hits, hits + 1)
+
+        memo.clear()
+        self.assertEqual((len(memo), memo.hits, memo.misses, memo.hit_rate), (0, 0, 0, 0.0))
+
+
+class StatsTest(unittest.TestCase):
+
+    def tearDown(self):
+        pyaes.disable_stats()
+        pyaes.reset_stats()
+
+    def test_counts(self):
+        (key, data) = (os.urandom(16), os.urandom(100))
+        expected = pyaes.AESModeOfOperationCTR(key).encrypt(data)
+        encrypt = pyaes.AESModeOfOperationCTR.encrypt
+
+        pyaes.enable_stats()
+        pyaes.reset_stats()
+        # Only the new key is expanded
+        self.assertNotEqual(pyaes.AESModeOfOperationCTR(os.urandom(16)).encrypt(data), expected)
+        self.assertEqual(pyaes.AESModeOfOperationCTR(key).encrypt(data), expected)
+
+        stats = pyaes.stats()
+        self.assertTrue(stats['enabled'])
+        self.assertEqual(stats['key_schedules'], 1)
+        self.assertEqual(stats['blocks']['encrypt'], 14)
+        self.assertEqual(stats['modes']['ctr'], dict(calls = 2, blocks = 14, bytes_in = 200, bytes_out = 200))
+        self.assertTrue(stats['ns']['block_cipher'] > 0)
+
+        # Disabling restores the methods and keeps the statistics
+        pyaes.disable_stats()
+        self.assertTrue(pyaes.AESModeOfOperationCTR.encrypt is encrypt)
+        pyaes.AESModeOfOperationCTR(key).encrypt(data)
+        self.assertEqual(pyaes.stats()['modes']['ctr']['calls'], 2)
+        self.assertFalse(pyaes.stats()['enabled'])
+
+        pyaes.reset_stats()
+        self.assertEqual(pyaes.stats()['modes'], { })
+
+    def test_lazy_import(self):
+        script = 'import sys, pyaes; print(("pyaes.instrumentation" in sys.modules, pyaes.stats()["enabled"]))'
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for (value, expected) in ((None, '(False, False)'), ('1', '(True, True)')):
+            env = dict(os.environ)
+            env.pop('PYAES_STATS', None)
+            if value is not None:
+                env['PYAES_STATS'] = value
+            output = subprocess.check_output([ sys.executable, '-c', script ], cwd = directory, env = env)
+            self.assertEqual(output.decode().strip(), expected)
+
+
+class FeederTest(unittest.TestCase):
+
+    def setUp(self):
+        (self.key, self.iv) = (os.urandom(16), os.urandom(16))
+        self.plaintext = os.urandom(1000)
+
+    def _modes(self):
+        (key, iv) = (self.key, self.iv)
+        return [
+            lambda: pyaes.AESModeOfOperationECB(key),
+            lambda: pyaes.AESModeOfOperationCBC(key, iv),
+            lambda: pyaes.AESModeOfOperationCFB(key, iv, 8),
+            lambda: pyaes.AESModeOfOperationOFB(key, iv),
+            lambda: pyaes.AESModeOfOperationCTR(key),
+            lambda: pyaes.AESModeOfOperationGCM(key, iv[:12]),
+        ]
+
+    def _feed(self, feeder, data, sizes):
+        (result, offset) = ([ ], 0)
+        while offset < len(data):
+            for size in sizes:
+                result.append(feeder.feed(data[offset:offset + size]))
+                offset += size
+        result.append(feeder.feed())
+        return b''.join(result)
+
+    def test_cbc_padding(self):
+        'The feeder output is CBC with PKCS#7 padding.'
+
+        padded = self.plaintext + b'\x08' * 8
+        expected = pyaes.AESModeOfOperationCBC(self.key, self.iv).encrypt_blocks(padded)
+        encrypter = pyaes.Encrypter(pyaes.AESModeOfOperationCBC(self.key, self.iv))
+        self.assertEqual(self._feed(encrypter, self.plaintext, [ 1000 ]), expected)
+
+    def test_chunks(self):
+        'Any split of the input, of any buffer type, gives the same output.'
+
+        for create in self._modes():
+            expected = self._feed(pyaes.Encrypter(create()), self.plaintext, [ len(self.plaintext) ])
+            self.assertEqual(self._feed(pyaes.Decrypter(create()), expected, [ len(expected) ]), self.plaintext)
+
+            for (sizes, convert) in (([ 1 ], bytes), ([ 15, 17, 100 ], bytearray), ([ 16, 7 ], memoryview)):
+                encrypter = pyaes.Encrypter(create())
+                self.assertEqual(self._feed(encrypter, convert(self.plaintext), sizes), expected)
+                decrypter = pyaes.Decrypter(create())
+                self.assertEqual(self._feed(decrypter, convert(expected), sizes), self.plaintext)
+
+    def test_buffer(self):
+        'The feeder only holds back what it cannot convert yet.'
+
+        encrypter = pyaes.Encrypter(pyaes.AESModeOfOperationCBC(self.key, self.iv))
+        for i in range(0, len(self.plaintext), 100):
+            encrypter.feed(self.plaintext[i:i + 100])
+            self.assertTrue(len(encrypter._buffer) <= 31)
+        encrypter.feed()
+        self.assertRaises(ValueError, encrypter.feed, b'\0')
+
+    def test_bulk(self):
+        'ECB and CBC convert all the whole blocks of each feed in one call.'
+
+        for mode in (pyaes.AESModeOfOperationECB, pyaes.AESModeOfOperationCBC):
+            for (feeder, name) in ((pyaes.Encrypter, 'encrypt_blocks'), (pyaes.Decrypter, 'decrypt_blocks')):
+                with mock.patch.object(mode, name, autospec = True, side_effect = getattr(mode, name)) as method:
+                    instance = feeder(mode(self.key))
+                    self.assertEqual(len(instance.feed(self.plaintext[:992])), 976)
+                    self.assertEqual(len(instance.feed(self.plaintext[992:])), 0)
+                    self.assertEqual([ len(call[0][1]) for call in method.call_args_list ], [ 976 ])
+
+
+class _Reader(object):
+    'A stream with only read, which may fail after some bytes.'
+
+    def __init__(self, data, fail_at = None):
+        (self._stream, self._fail_at) = (BytesIO(data), fail_at)
+
+    def read(self, size):
+        if self._fail_at is not None and self._stream.tell() >= self._fail_at:
+            raise IOError('read failed')
+        return self._stream.read(size)
+
+class _FailingWriter(object):
+    def write(self, data):
+        raise IOError('write failed')
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        (self.key, self.iv) = (os.urandom(16), os.urandom(16))
+        self.plaintext = os.urandom(100000)
+
+    def _modes(self):
+        (key, iv) = (self.key, self.iv)
+        return [
+            lambda: pyaes.AESModeOfOperationCBC(key, iv),
+            lambda: pyaes.AESModeOfOperationCTR(key),
+            lambda: pyaes.AESModeOfOperationGCM(key, iv[:12]),
+        ]
+
+    def test_round_trip(self):
+        for create in self._modes():
+            output = BytesIO()
+            pyaes.encrypt_stream(create(), BytesIO(self.plaintext), output)
+            expected = output.getvalue()
+
+            for (stream, block_size) in ((BytesIO, None), (BytesIO, 1000), (_Reader, None), (_Reader, 4096)):
+                output = BytesIO()
+                pyaes.encrypt_stream_pipelined(create(), stream(self.plaintext), output, block_size)
+                self.assertEqual(output.getvalue(), expected)
+
+                output = BytesIO()
+                pyaes.decrypt_stream_pipelined(create(), stream(expected), output, block_size)
+                self.assertEqual(output.getvalue(), self.plaintext)
+
+    def test_errors(self):
+        mode = pyaes.AESModeOfOperationCBC(self.key, self.iv)
+        self.assertRaises(IOError, pyaes.encrypt_stream_pipelined, mode, _Reader(self.plaintext, 20000), BytesIO(), 8192)
+
+        mode = pyaes.AESModeOfOperationCBC(self.key, self.iv)
+        self.assertRaises(IOError, pyaes.encrypt_stream_pipelined, mode, BytesIO(self.plaintext), _FailingWriter())
+
+        # A bad tag is raised from the cipher stage
+        output = BytesIO()
+        pyaes.encrypt_stream(self._modes()[2](), BytesIO(self.plaintext), output)
+        ciphertext = output.getvalue()[:-1] + b'\0'
+        self.assertRaises(ValueError, pyaes.decrypt_stream_pipelined, self._modes()[2](), BytesIO(ciphertext), BytesIO())
+
+    def test_tuner(self):
+        from pyaes.blockfeeder import _BlockSizeTuner
+
+        tuner = _BlockSizeTuner(minimum = 1024, maximum = 1 << 20, samples = 1)
+        # Throughput keeps improving up to 8 KB, then levels off
+        rates = { 1024: 1.0, 2048: 2.0, 4096: 3.0, 8192: 3.2, 16384: 3.3 }
+        while not tuner.settled:
+            size = tuner.size
+            for stage in tuner.STAGES:
+                tuner.record(stage, size, size, size / rates[size])
+        self.assertEqual(tuner.size, 8192)
+
+
+class FileTest(unittest.TestCase):
+    'python -m pyaes (filecrypt.py)'
+
+    def setUp(self):
+        from pyaes import filecrypt
+        self.filecrypt = filecrypt
+
+        self.directory = tempfile.mkdtemp()
+        self.key = os.urandom(16)
+        self.plaintext = os.urandom(50000)
+        self.paths = [ os.path.join(self.directory, name) for name in ('plain', 'encrypted', 'decrypted') ]
+        with open(self.paths[0], 'wb') as f:
+            f.write(self.plaintext)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_crypt_file(self):
+        nonce = os.urandom(12)
+        for (initial_value, nonce, jobs) in ((1, None, 1), ((1 << 64) - 3, None, 2), (0xffff0000, nonce, 1)):
+            expected = pyaes.AESModeOfOperationCTR(self.key, pyaes.Counter(initial_value, nonce)).encrypt(self.plaintext)
+
+            (plain, encrypted, decrypted) = self.paths
+            size = self.filecrypt.crypt_file(plain, encrypted, self.key, initial_value, nonce, jobs, chunk_size = 4096)
+            self.assertEqual(size, len(self.plaintext))
+            self.assertEqual(self._read(encrypted), expected)
+
+            self.filecrypt.crypt_file(encrypted, decrypted, self.key, initial_value, nonce, jobs, chunk_size = 4096)
+            self.assertEqual(self._read(decrypted), self.plaintext)
+
+    def test_counter_wrap(self):
+        (plain, encrypted, decrypted) = self.paths
+        for (initial_value, nonce) in ((0xffffffff, os.urandom(12)), ((1 << 128) - 16, None)):
+            self.assertRaises(ValueError, self.filecrypt.crypt_file, plain, encrypted, self.key, initial_value, nonce)
+            self.assertFalse(os.path.exists(encrypted))
+
+    def test_command_line(self):
+        (plain, encrypted, decrypted) = self.paths
+        directory = os.path.dirname(os.path.abspath(__file__))
+        key = binascii.hexlify(self.key).decode()
+
+        def run(*args):
+            command = [ sys.executable, '-m', 'pyaes' ] + list(args)
+            return subprocess.call(command, cwd = directory, stderr = subprocess.DEVNULL)
+
+        self.assertEqual(run('encrypt', '--key', key, '--counter', '00' * 15 + '05', '-q', plain, encrypted), 0)
+        expected = pyaes.AESModeOfOperationCTR(self.key, pyaes.Counter(5)).encrypt(self.plaintext)
+        self.assertEqual(self._read(encrypted), expected)
+
+        self.assertEqual(run('decrypt', '--key', key, '--counter', '00' * 15 + '05', '-q', '-j', '2', encrypted, decrypted), 0)
+        self.assertEqual(self._read(decrypted), self.plaintext)
+
+        # Wrapping the counter, and bad arguments
+        self.assertEqual(run('encrypt', '--key', key, '--counter', 'ff' * 16, '-q', plain, decrypted), 1)
+        self.assertEqual(run('encrypt', '--key', key[:-2], plain, decrypted), 2)
+        self.assertEqual(run('encrypt', '--key', key, plain, plain), 2)
+
+
+class _StreamWriter(object):
+    'The write and drain of an asyncio.StreamWriter, into a BytesIO.'
+
+    def __init__(self):
+        self.output = BytesIO()
+
+    def write(self, data):
+        self.output.write(data)
+
+    async def drain(self):
+        pass
+
+class _Echo(asyncio.Protocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.transport.write(data)
+
+class _Client(asyncio.Protocol):
+    'Writes messages and an EOF, then collects what comes back.'
+
+    def __init__(self, messages, done):
+        (self.messages, self.done, self.received) = (messages, done, bytearray())
+
+    def connection_made(self, transport):
+        for message in self.messages:
+            transport.write(message)
+        transport.write_eof()
+
+    def data_received(self, data):
+        self.received += data
+
+    def connection_lost(self, exc):
+        self.done.set_result((bytes(self.received), exc))
+
+
+class AsyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.key = os.urandom(16)
+        (self.iv_a, self.iv_b) = (os.urandom(16), os.urandom(16))
+
+    def _modes(self, iv):
+        key = self.key
+        return [
+            lambda: pyaes.AESModeOfOperationECB(key),
+            lambda: pyaes.AESModeOfOperationCBC(key, iv),
+            lambda: pyaes.AESModeOfOperationCFB(key, iv, 16),
+            lambda: pyaes.AESModeOfOperationOFB(key, iv),
+            lambda: pyaes.AESModeOfOperationCTR(key, pyaes.Counter(int(binascii.hexlify(iv), 16))),
+            lambda: pyaes.AESModeOfOperationGCM(key, iv[:12]),
+        ]
+
+    def test_streams(self):
+        from pyaes.asyncfeeder import decrypt_stream_async, encrypt_stream_async
+
+        async def crypt(function, mode, data):
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            writer = _StreamWriter()
+            await function(mode, reader, writer, block_size = 5000, inline_threshold = 4096)
+            return writer.output.getvalue()
+
+        for create in self._modes(self.iv_a):
+            for size in (0, 15, 100, 20000):
+                plaintext = os.urandom(size)
+                output = BytesIO()
+                pyaes.encrypt_stream(create(), BytesIO(plaintext), output)
+
+                ciphertext = asyncio.run(crypt(encrypt_stream_async, create(), plaintext))
+                self.assertEqual(ciphertext, output.getvalue())
+                self.assertEqual(asyncio.run(crypt(decrypt_stream_async, create(), ciphertext)), plaintext)
+
+    def _connect(self, server_protocol, client_protocol):
+        async def run():
+            loop = asyncio.get_running_loop()
+            done = loop.create_future()
+            server = await loop.create_server(server_protocol, '127.0.0.1', 0)
+            try:
+                port = server.sockets[0].getsockname()[1]
+                await loop.create_connection(lambda: client_protocol(done), '127.0.0.1', port)
+                return await asyncio.wait_for(done, 20)
+            finally:
+                server.close()
+                await server.wait_closed()
+        return asyncio.run(run())
+
+    def test_protocol(self):
+        from pyaes.asyncfeeder import CipherProtocol
+
+        messages = [ os.urandom(size) for size in (5, 100, 20000, 3, 1) ]
+        for (create_a, create_b) in zip(self._modes(self.iv_a), self._modes(self.iv_b)):
+            def server():
+                return CipherProtocol(_Echo(), create_b(), create_a(), inline_threshold = 4096)
+            def client(done):
+                return CipherProtocol(_Client(messages, done), create_a(), create_b(), inline_threshold = 4096)
+
+            self.assertEqual(self._connect(server, client), (b''.join(messages), None))
+
+    def test_protocol_bad_tag(self):
+        from pyaes.asyncfeeder import CipherProtocol
+
+        class Forger(asyncio.Protocol):
+            def connection_made(self, transport):
+                transport.write(b'x' * 40)
+                transport.write_eof()
+
+        create = self._modes(self.iv_a)[5]
+        def client(done):
+            return CipherProtocol(_Client([ ], done), create(), create())
+
+        (received, exc) = self._connect(Forger, client)
+        self.assertTrue(isinstance(exc, ValueError))
+
+    def test_protocol_inline(self):
+        'Small CTR chunks are delivered at once, without waiting for more.'
+
+        from pyaes.asyncfeeder import CipherProtocol
+
+        received = [ ]
+        class Protocol(asyncio.Protocol):
+            def data_received(self, data):
+                received.append(data)
+
+        class Transport(asyncio.Transport):
+            def write(self, data):
+                pass
+            def is_closing(self):
+                return False
+
+        create = self._modes(self.iv_a)[4]
+        protocol = CipherProtocol(Protocol(), create(), create())
+        protocol.connection_made(Transport())
+        protocol.data_received(create().encrypt(b'hello'))
+        self.assertEqual(received, [ b'hello' ])
+
+
+class BackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.blocks = os.urandom(16 * 97)
+
+    def _with_backend(self, name, function):
+        backend = os.environ.get('PYAES_BACKEND')
+        os.environ['PYAES_BACKEND'] = name
+        try:
+            return function()
+        finally:
+            if backend is None:
+                del os.environ['PYAES_BACKEND']
+            else:
+                os.environ['PYAES_BACKEND'] = backend
+
+    def test_minimal_backend(self):
+        'A backend with only encrypt and decrypt works with every mode.'
+
+        class Minimal(object):
+            def __init__(self, key):
+                self._aes = aes.AESUnrolled(key)
+            def encrypt(self, block):
+                return self._aes.encrypt(block)
+            def decrypt(self, block):
+                return self._aes.decrypt(block)
+
+        (key, iv) = (os.urandom(16), os.urandom(16))
+        data = os.urandom(2000)
+        blocks = data[:1984]
+
+        def crypt():
+            return [
+                pyaes.AESModeOfOperationECB(key).encrypt_blocks(blocks),
+                pyaes.AESModeOfOperationECB(key).decrypt_blocks(blocks),
+                pyaes.AESModeOfOperationCBC(key, iv).encrypt_blocks(blocks),
+                pyaes.AESModeOfOperationCBC(key, iv).decrypt_blocks(blocks),
+                pyaes.AESModeOfOperationCFB(key, iv, 16).encrypt(blocks),
+                pyaes.AESModeOfOperationOFB(key, iv).encrypt(data),
+                pyaes.AESModeOfOperationCTR(key).encrypt(data),
+                pyaes.AESModeOfOperationGCM(key, iv[:12]).encrypt_and_digest(data),
+            ]
+
+        aes.register_backend('minimal', Minimal)
+        try:
+            self.assertEqual(self._with_backend('minimal', crypt), crypt())
+        finally:
+            del aes._backends['minimal']
+
+    def test_unavailable_backend(self):
+        'A backend that cannot be used falls back to the Python engine.'
+
+        def unavailable(key):
+            raise OSError('not here')
+
+        key = os.urandom(16)
+        aes.register_backend('unavailable', unavailable)
+        try:
+            mode = self._with_backend('unavailable', lambda: pyaes.AESModeOfOperationECB(key))
+        finally:
+            del aes._backends['unavailable']
+        self.assertEqual(mode.encrypt_blocks(self.blocks), _encrypt_all(aes.AES(key), self.blocks))
+
+    def test_libcrypto(self):
+        try:
+            from pyaes.libcrypto import LibcryptoAES
+            LibcryptoAES(b'\0' * 16)
+        except (ImportError, OSError):
+            self.skipTest('libcrypto is not available')
+
+        for size in (16, 24, 32):
+            key = os.urandom(size)
+            (engine, backend) = (aes.AES(key), LibcryptoAES(key))
+            block = self.blocks[:16]
+            self.assertEqual(backend.encrypt(block), _encrypt(engine, block))
+            self.assertEqual(backend.decrypt(block), _decrypt(engine, block))
+
+            encrypted = _encrypt_all(engine, self.blocks)
+            self.assertEqual(backend.encrypt_blocks(self.blocks), encrypted)
+            self.assertEqual(backend.decrypt_blocks(encrypted), self.blocks)
+
+            # CTR keystream across a carry out of the low 64 bits
+            counter = pyaes.Counter((1 << 64) - 2)
+            start = counter.value
+            self.assertEqual(backend.ctr_keystream(start, 4), _encrypt_all(engine, counter.blocks(4)))
+
+            # CBC encryption
+            (iv, last, expected) = (self.blocks[:16], self.blocks[:16], [ ])
+            for i in range(0, len(self.blocks), 16):
+                last = _encrypt(engine, aes._xor_bytes(self.blocks[i:i + 16], last))
+                expected.append(last)
+            self.assertEqual(backend.cbc_encrypt(iv, self.blocks), b''.join(expected))
+
+    def test_libcrypto_incomplete(self):
+        'A libcrypto without the functions used is unavailable.'
+
+        try:
+            from pyaes import libcrypto
+        except ImportError:
+            self.skipTest('ctypes is not available')
+
+        class Library(object):
+            EVP_CIPHER_CTX_new = EVP_CIPHER_CTX_free = EVP_CIPHER_CTX_set_padding = mock.Mock()
+
+        key = os.urandom(16)
+        with mock.patch.object(libcrypto, '_library', None):
+            with mock.patch('ctypes.util.find_library', return_value = 'libcrypto.so'):
+                with mock.patch('ctypes.CDLL', return_value = Library()):
+                    self.assertRaises(OSError, libcrypto.LibcryptoAES, key)
+                    mode = self._with_backend('libcrypto', lambda: pyaes.AESModeOfOperationECB(key))
+        self.assertEqual(mode.encrypt_blocks(self.blocks), _encrypt_all(aes.AES(key), self.blocks))
+
+
+class PrefetchTest(unittest.TestCase):
+    'Prefetched keystream gives the same stream as none.'
+
+    def setUp(self):
+        self.key = os.urandom(16)
+        self.data = os.urandom(1000)
+        self.expected = pyaes.AESModeOfOperationCTR(self.key).encrypt(self.data)
+
+    def _encrypt(self, mode, prefetcher):
+        pieces = [ ]
+        for (i, j) in ((0, 3), (3, 300), (300, 301), (301, 1000)):
+            pieces.append(mode.encrypt(self.data[i:j]))
+            prefetcher.step()
+        return b''.join(pieces)
+
+    def test_step(self):
+        mode = pyaes.AESModeOfOperationCTR(self.key)
+        prefetcher = pyaes.KeystreamPrefetcher(mode, limit = 256, step_size = 64)
+
+        steps = 0
+        while prefetcher.step():
+            steps += 1
+        self.assertEqual(steps, 3)
+        self.assertEqual(len(mode._remaining_counter), 256)
+
+        self.assertEqual(self._encrypt(mode, prefetcher), self.expected)
+
+    def test_schedule(self):
+        callbacks = [ ]
+        def ao_sleep(interval, callback):
+            callbacks.append(callback)
+
+        mode = pyaes.AESModeOfOperationCTR(self.key)
+        pyaes.KeystreamPrefetcher(mode, limit = 256, step_size = 64).schedule(ao_sleep)
+        while callbacks:
+            callbacks.pop(0)()
+        self.assertEqual(len(mode._remaining_counter), 256)
+
+        # Using keystream schedules a refill
+        self.assertEqual(mode.encrypt(self.data[:100]), self.expected[:100])
+        self.assertEqual(len(callbacks), 1)
+        while callbacks:
+            callbacks.pop(0)()
+        self.assertTrue(len(mode._remaining_counter) >= 256)
+        self.assertEqual(mode.encrypt(self.data[100:]), self.expected[100:])
+
+    def test_thread(self):
+        mode = pyaes.AESModeOfOperationCTR(self.key)
+        prefetcher = pyaes.KeystreamPrefetcher(mode, limit = 256, step_size = 16).start()
+
+        pieces = [ ]
+        for i in range(0, len(self.data), 7):
+            pieces.append(mode.encrypt(self.data[i:i + 7]))
+        self.assertEqual(b''.join(pieces), self.expected)
+
+        self.assertEqual(mode.encrypt_at(500, self.data[500:]), self.expected[500:])
+
+
+class GCMTest(unittest.TestCase):
+
+    def tearDown(self):
+        pyaes.AESModeOfOperationGCM.ghash_table_bits = 8
+
+    def test_vectors(self):
+        for bits in (8, 4):
+            pyaes.AESModeOfOperationGCM.ghash_table_bits = bits
+            for vector in GCM:
+                (key, iv, plaintext, associated_data, ciphertext, tag) = [ _unhex(v) for v in vector ]
+
+                mode = pyaes.AESModeOfOperationGCM(key, iv, associated_data)
+                self.assertEqual(mode.encrypt_and_digest(plaintext), (ciphertext, tag))
+
+                mode = pyaes.AESModeOfOperationGCM(key, iv, associated_data)
+                self.assertEqual(mode.decrypt_and_verify(ciphertext, tag), plaintext)
+
+                # In uneven pieces
+                mode = pyaes.AESModeOfOperationGCM(key, iv)
+                mode.update(associated_data[:3])
+                mode.update(associated_data[3:])
+                pieces = [ mode.encrypt(plaintext[i:j]) for (i, j) in ((0, 7), (7, 40), (40, None)) ]
+                self.assertEqual(b''.join(pieces), ciphertext)
+                self.assertEqual(mode.digest(), tag)
+
+                # A truncated tag is a prefix of the full one
+                mode = pyaes.AESModeOfOperationGCM(key, iv, associated_data, tag_size = 12)
+                self.assertEqual(mode.encrypt_and_digest(plaintext)[1], tag[:12])
+
+    def test_bad_tag(self):
+        (key, iv, plaintext, associated_data, ciphertext, tag) = [ _unhex(v) for v in GCM[3] ]
+        bad = tag[:-1] + bytes(bytearray([ tag[-1] ^ 1 ]))
+        mode = pyaes.AESModeOfOperationGCM(key, iv, associated_data)
+        self.assertRaises(ValueError, mode.decrypt_and_verify, ciphertext, bad)
+
+    def test_streams(self):
+        (key, iv, plaintext, associated_data, ciphertext, tag) = [ _unhex(v) for v in GCM[3] ]
+
+        output = BytesIO()
+        pyaes.encrypt_stream(pyaes.AESModeOfOperationGCM(key, iv, associated_data), BytesIO(plaintext), output, block_size = 16)
+        self.assertEqual(output.getvalue(), ciphertext + tag)
+
+        output = BytesIO()
+        pyaes.decrypt_stream(pyaes.AESModeOfOperationGCM(key, iv, associated_data), BytesIO(ciphertext + tag), output, block_size = 16)
+        self.assertEqual(output.getvalue(), plaintext)
+
+    def test_message_limit(self):
+        mode = pyaes.AESModeOfOperationGCM(b'\0' * 16, b'\0' * 12)
+        mode._length = mode.max_message_bytes - 16
+        mode.encrypt(b'\0' * 16)
+        self.assertRaises(ValueError, mode.encrypt, b'\0')
+
+
+if __name__ == '__main__':
+    unittest.main()